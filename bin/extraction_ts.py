@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
-import os, sys, logging, subprocess
-import mrcfile
+import os, sys, logging, subprocess, functools
 import imodmodel
 import numpy as np
+from multiprocessing import Pool
+from scipy.spatial import cKDTree
 
 from TomoNet.util.io import log
 from TomoNet.util.utils import mkfolder
-from TomoNet.preprocessing.cubes import create_cube_seeds_new, crop_cubes, normalize
+from TomoNet.preprocessing.cubes import create_cube_seeds_new, crop_cubes, normalize, in_particle_boxes
+from TomoNet.preprocessing.labels import label_stamp, paste_stamp
+from TomoNet.preprocessing.shards import ShardWriter, merge_shards, split_shards
 from TomoNet.util.searchParam import SearchParam 
+from TomoNet.util.parallel import bounded_workers, tomogram_bytes
+from TomoNet.objects.tomogram_volume import TomogramVolume
 
 # check if coord d is inside the cube with center c
 def inZone(c, d, crop_size):
@@ -18,14 +23,20 @@ def inZone(c, d, crop_size):
 
 # check if the new coords is valid
 def getNewCoords(new_centers, old_coords, crop_size):
-    new_coords = []
-    for coord in old_coords:
-        if inZone(new_centers, coord, crop_size):
-            new_coords.append([coord[x] - new_centers[x] + (crop_size//2)  for x in range(0,3)])
-    return new_coords
+    return getNewCoordsAll([new_centers], old_coords, crop_size)[0].tolist()
+
+# coords (x, y, z) of the particles inside the cube of each seed (same as inZone), relative to the cube corner.
+# one cKDTree (chebyshev distance) query for all the seeds instead of testing every particle for every seed
+def getNewCoordsAll(new_centers, old_coords, crop_size, tree=None):
+    old_coords = np.asarray(old_coords).reshape(-1, 3)
+    new_centers = np.asarray(new_centers).reshape(-1, 3)
+    if tree is None:
+        tree = cKDTree(old_coords)
+    neighbors = tree.query_ball_point(new_centers, r=crop_size//2, p=np.inf, return_sorted=True)
+    return [old_coords[n].reshape(-1, 3) - c + (crop_size//2) for c, n in zip(new_centers, neighbors)]
 
 # subtomogram extraction for one tomogram
-def extract_subtomos_one(tomoName, maskName, coordsFile, data_dir, label_size, numberSubtomo, crop_size, bin, check_folder=True, logger=None):
+def extract_subtomos_one(tomoName, maskName, coordsFile, data_dir, label_size, numberSubtomo, crop_size, bin, check_folder=True, logger=None, label_kernel="diamond"):
 
     log(logger, "######## Extracting subtomograms from {} ########".format(tomoName))
     # read 3D volume
@@ -34,8 +45,8 @@ def extract_subtomos_one(tomoName, maskName, coordsFile, data_dir, label_size, n
     # else:
     baseName = os.path.basename(tomoName).split(".")[0]
 
-    with mrcfile.open(tomoName) as mrcData:
-        orig_data = mrcData.data.astype(np.float32)
+    # memory-mapped, only the cropped subtomograms are read (as float32)
+    orig_data = TomogramVolume(tomoName, permissive=False)
     
     # centers of subtomograms
     centers = []
@@ -52,63 +63,43 @@ def extract_subtomos_one(tomoName, maskName, coordsFile, data_dir, label_size, n
 
     # scale coords
     centers = (np.array(centers)*bin).astype(int)
+    # spatial index of the particles, used to find the particles of each subtomogram
+    centers_tree = cKDTree(centers.reshape(-1, 3))
         
     # handling mask
+    mask = None
     if maskName in [None, "None"]:
-        sp = orig_data.shape
-        mask_data = np.zeros(sp)
-
-        # generating mask near density with particles
-        for c in centers:
-            x, y, z = c
-
-            low_x = x-crop_size//2 if x > crop_size//2 else 1
-            low_y = y-crop_size//2 if y > crop_size//2 else 1
-            low_z = z-crop_size//2 if z > crop_size//2 else 1
-            high_x = x+crop_size//2 if x < (sp[2] - crop_size//2)  else sp[2]
-            high_y = y+crop_size//2 if y < (sp[1] - crop_size//2)  else sp[1]
-            high_z = z+crop_size//2 if z < (sp[0] - crop_size//2)  else sp[0]
-            
-            mask_data[low_z:high_z, low_y:high_y, low_x:high_x] = 1
-
-        #check mask using density map
-        #with mrcfile.new("mask.mrc", overwrite=True) as output_mrc:
-        #    output_mrc.set_data(mask_data.astype(np.float32))
+        # subtomos near density with particles: seed candidates are checked against the box of each particle,
+        # no full size mask volume is built
+        mask_data = functools.partial(in_particle_boxes, centers=centers, cubeSideLen=crop_size, shape=orig_data.shape, tree=centers_tree)
     else:
-        with mrcfile.open(maskName) as m:
-            mask_data = m.data
+        mask = TomogramVolume(maskName, permissive=False)
+        mask_data = mask.data
 
     # generating seeds(centers) locations for subtomograms
     seeds = create_cube_seeds_new(orig_data, numberSubtomo, crop_size, centers, mask=mask_data, logger=logger)
+    if mask is not None:
+        mask.close()
     if seeds == None:
+        orig_data.close()
         return
     # check if all seeds locations are valid and they will be used for labeling volume generation
-    label_coords = []
-    for i in range(0, len(seeds[0])):
-        newCoords_i = getNewCoords([seeds[2][i], seeds[1][i], seeds[0][i]], centers, crop_size)
-        label_coords.append(newCoords_i)
+    label_coords = getNewCoordsAll(np.stack([seeds[2], seeds[1], seeds[0]], axis=1), centers, crop_size, tree=centers_tree)
     
     # crop from the global volume and save to individual subtomogram on disk
     subtomos = crop_cubes(orig_data, seeds, crop_size)
+    orig_data.close()
 
-    # if the extraction folder was not generated, then make one, all subtomograms will be saved to train and test subsets
+    # if the extraction folder was not generated, then make one, subtomograms of each tomogram are written to its own shards
     #base_name = os.path.splitext(os.path.basename(tomoName))[0]
-    dirs_tomake = ['train_x','train_y', 'test_x', 'test_y']
     if check_folder:        
         mkfolder(data_dir)
-        dirs_tomake = ['train_x','train_y', 'test_x', 'test_y']
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-        for d in dirs_tomake:
-            folder = '{}/{}'.format(data_dir, d)
-            if not os.path.exists(folder):
-                os.makedirs(folder)
 
     shape = subtomos[0].shape
+    writer = ShardWriter(data_dir, baseName, shape)
+    # label stamp is built once and pasted at every particle
+    stamp = label_stamp(label_size, label_kernel)
     for j, s in enumerate(subtomos):
-        x_name = '{}/{}/{}_x_{}.mrc'.format(data_dir, dirs_tomake[0], baseName, j)
-        y_name = '{}/{}/{}_y_{}.mrc'.format( data_dir, dirs_tomake[1], baseName, j)
-
         if len(label_coords[j]) > 0:
             y_temp = np.zeros(shape, dtype=np.float32)
             # random_indices_x = np.random.choice(y_temp.shape[2], int(y_temp.shape[2]))
@@ -129,78 +120,15 @@ def extract_subtomos_one(tomoName, maskName, coordsFile, data_dir, label_size, n
             #                 if abs(z-z_i) + abs(y-y_i) + abs(x-x_i) <= label_size:
             #                     y_temp[z_i,y_i,x_i] = -0.5
 
-            for coords in label_coords[j]:
-                #mrcfile store image in zyx order
-                x = coords[0]-1 if coords[0]>0 else 0
-                y = coords[1]-1 if coords[1]>0 else 0
-                z = coords[2]-1 if coords[2]>0 else 0
-                
-                
-                #Gradient Probability distribution (Option 1)
-                # p_step = 1/label_size
-                # for i in range(label_size):
-                #     j=i+1
-                #     xmin = x - i if x >= j else 0
-                #     xmax = x + j if x <= shape[2] -j else shape[2] -1
-                #     ymin = y - i if y >= j else 0
-                #     ymax = y + j if y <= shape[1] -j else shape[1] -1
-                #     zmin = z - i if z >= j else 0
-                #     zmax = z + j if z <= shape[0] -j else shape[0] -1
-                #     y_temp[zmin:zmax,ymin:ymax,xmin:xmax] += p_step
-                #     #y_temp[zmin:zmax,ymin:ymax,xmin:xmax] = 1
-                # #y_temp[z,y,x] = 1
-                
-                # defining boundary for the current subtomogram
-                xmin = x - label_size if x >= label_size else 0
-                xmax = x + label_size + 1 if x < shape[2] - label_size else shape[2]
-                ymin = y - label_size if y >= label_size else 0
-                ymax = y + label_size + 1 if y < shape[1] - label_size else shape[1]
-                zmin = z - label_size if z >= label_size else 0
-                zmax = z + label_size + 1 if z < shape[0] - label_size else shape[0]
-                
-                #Option 2 (cubic labeling)
-                #y_temp[zmin:zmax,ymin:ymax,xmin:xmax] = 1
-                #labeling (psedo sphere)
-                #radius_label = label_size
-                #tuple_x, tuple_y, tuple_z = np.mgrid[0:xmax-xmin:1, 0:ymax-ymin:1, 0:zmax-zmin:1]
-                #distance_label = np.sqrt((tuple_x - x)**2 + (tuple_y - y)**2 + (tuple_z - z)**2)
-                #distance_label[distance_label > radius_label] = -1
-                #distance_label[distance_label >=0] = 1
-                
+            #mrcfile store image in zyx order
+            for z, y, x in np.maximum(label_coords[j][:, ::-1]-1, 0):
+                # particle labels (diamond shape by default, see preprocessing/labels.py for the other kernels)
+                paste_stamp(y_temp, stamp, (z, y, x))
 
-                #Option 3 (sphere labeling-- dimond shape labeling)
-                for z_i in range(zmin,zmax):
-                    for y_i in range(ymin,ymax):
-                        for x_i in range(xmin,xmax):
-                            if abs(z-z_i) + abs(y-y_i) + abs(x-x_i) <= label_size:
-                                y_temp[z_i,y_i,x_i] = 1
-
-            #data Augmentation (rotate volume but keep the missing wedge shape the same, so limited to 4 rotations)    
-            for l in range(4):
-                x_name = '{}/{}/{}_x_{}_{}.mrc'.format(data_dir, dirs_tomake[0], baseName, j, l)
-                y_name = '{}/{}/{}_y_{}_{}.mrc'.format( data_dir, dirs_tomake[1], baseName, j, l)
-                # original
-                if l == 0:
-                    rotated_x = s
-                    rotated_y = y_temp
-                # 180 degree on X-axis
-                elif l ==1:
-                    rotated_x = np.rot90(s, k=2, axes=(0,1))
-                    rotated_y = np.rot90(y_temp, k=2, axes=(0,1))
-                # 180 degree on Z-axis
-                elif l ==2:
-                    rotated_x = np.rot90(s, k=2, axes=(1,2))
-                    rotated_y = np.rot90(y_temp, k=2, axes=(1,2))
-                # 180 degree on Y-axis
-                elif l ==3:
-                    rotated_x = np.rot90(s, k=2, axes=(0,2))
-                    rotated_y = np.rot90(y_temp, k=2, axes=(0,2))
-
-                # save on disk
-                with mrcfile.new(x_name, overwrite=True) as output_mrc:
-                    output_mrc.set_data(normalize(rotated_x))
-                with mrcfile.new(y_name, overwrite=True) as output_mrc:
-                    output_mrc.set_data(rotated_y)
+            #data Augmentation (rotate volume but keep the missing wedge shape the same, so limited to 4 rotations)
+            #only the original is saved, the 4 rotations are applied on the fly by the training data set (see merge_shards in split_data)
+            writer.add(normalize(s), y_temp)
+    writer.close()
 
 # split traning dataset into train and test            
 def split_data(data_dir):    
@@ -208,17 +136,15 @@ def split_data(data_dir):
     batch_size = 4
     ratio = 0.1
     
-    #assigning classes
-    all_path_x = os.listdir(data_dir+'/train_x')
-    num_test = int(len(all_path_x) * ratio) 
+    #collect the shards of all tomograms, each subtomogram is used with 4 wedge preserving rotations
+    rotations = 4
+    manifest = merge_shards(data_dir, rotations=rotations)
+    num_test = int(manifest["count"] * rotations * ratio) 
     num_test = num_test - num_test%batch_size + batch_size
-    all_path_y = [i.split('_x_')[0]+'_y_'+i.split('_x_')[1] for i in all_path_x ]
 
-    #organizing based on distribution
-    ind = np.random.permutation(len(all_path_x))[0:num_test]
-    for i in ind:
-        os.rename('{}/train_x/{}'.format(data_dir, all_path_x[i]), '{}/test_x/{}'.format(data_dir, all_path_x[i]) )
-        os.rename('{}/train_y/{}'.format(data_dir, all_path_y[i]), '{}/test_y/{}'.format(data_dir, all_path_y[i]) )
+    #organizing based on distribution, only the index lists of the manifest change.
+    #all the rotations of a subtomogram stay in the same subset
+    split_shards(data_dir, -(-num_test//rotations))
             
 if __name__ == "__main__":
 
@@ -259,6 +185,8 @@ if __name__ == "__main__":
     subtomo_num = train_params.subtomo_num
     cube_size = train_params.subtomo_box_size
     bin = train_params.coords_scale
+    # label shape: "diamond" (default), "sphere", "cube", "gradient" or "gaussian"
+    label_kernel = train_params.label_kernel if hasattr(train_params, "label_kernel") else "diamond"
 
     # # read params #
     # params = sys.argv    
@@ -354,10 +282,24 @@ if __name__ == "__main__":
     # extraction
     log(logger, "Start subtomograms Extraction!")
 
-    extract_subtomos_one(tomoList[0], maskList[0], coordsList[0], data_dir, label_size, subtomo_num, cube_size, logger=logger, bin=bin)
-    
-    for i, tomo in enumerate(tomoList[1:]):
-        extract_subtomos_one(tomo, maskList[i+1], coordsList[i+1], data_dir, label_size, subtomo_num, cube_size, bin=bin, check_folder=False, logger=logger)
+    mkfolder(data_dir)
+    tasks = [(tomo, maskList[i], coordsList[i], data_dir, label_size, subtomo_num, cube_size, bin, False, logger, label_kernel) \
+                for i, tomo in enumerate(tomoList)]
+
+    # tomograms are extracted in parallel, each one into its own shards. the number of workers is bounded by the
+    # cores asked for and by the memory needed for the largest tomogram (mask and labels) and its subtomograms
+    ncpus = train_params.extract_ncpus if hasattr(train_params, "extract_ncpus") else None
+    task_bytes = 3*max([tomogram_bytes(tomo) for tomo in tomoList]) + 2*subtomo_num*cube_size**3*4
+    num_workers = bounded_workers(task_bytes, ncpus=ncpus, num_tasks=len(tasks))
+    log(logger, "Extract {} tomograms with {} worker(s)".format(len(tasks), num_workers))
+
+    if num_workers > 1:
+        # reseed numpy in each worker, otherwise forked workers draw the same seeds
+        with Pool(num_workers, initializer=np.random.seed) as p:
+            p.starmap(extract_subtomos_one, tasks)
+    else:
+        for task in tasks:
+            extract_subtomos_one(*task)
     
     # split data into train and test
     split_data(data_dir)
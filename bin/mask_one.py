@@ -7,16 +7,32 @@ from scipy.ndimage import gaussian_filter
 from TomoNet.util.filter import maxmask, stdmask
 from TomoNet.util.io import log
 from TomoNet.util.searchParam import SearchParam 
+from TomoNet.objects.tomogram_volume import TomogramVolume
+
+def resize_half(tomo, slab=32):
+        # half size resize (anti aliased) of a memory-mapped tomogram. Smoothing and interpolation are separable,
+        # so y and x are resized slab by slab along z first, then z on the quarter size result, slab by slab along y.
+        # the full size tomogram is never held in memory
+        sp = np.array(tomo.shape)
+        sp2 = sp//2
+        binyx = np.zeros((sp[0], sp2[1], sp2[2]), dtype=np.float32)
+        for z in range(0, sp[0], slab):
+            chunk = tomo[z:z+slab]
+            binyx[z:z+slab] = resize(chunk, (chunk.shape[0], sp2[1], sp2[2]), anti_aliasing=True)
+        bintomo = np.zeros(sp2, dtype=np.float32)
+        for y in range(0, sp2[1], slab):
+            chunk = binyx[:, y:y+slab]
+            bintomo[:, y:y+slab] = resize(chunk, (sp2[0], chunk.shape[1], sp2[2]), anti_aliasing=True)
+        return bintomo
 
 def make_mask_one(tomo_path, mask_name, mask_boundary = None, side = 5, density_percentage=50.0, std_percentage=50.0, surface=None, logger=None):
         
-        with mrcfile.open(tomo_path, permissive=True) as n:
-            header_input = n.header
-            pixel_size = n.voxel_size
-            tomo = n.data.astype(np.float32)
-        sp=np.array(tomo.shape)
+        with TomogramVolume(tomo_path) as n:
+            header_input = n.header.copy()
+            pixel_size = n.voxel_size.copy()
+            sp=np.array(n.shape)
+            bintomo = resize_half(n)
         sp2 = sp//2
-        bintomo = resize(tomo,sp2,anti_aliasing=True)
     
         gauss = gaussian_filter(bintomo, side/2)
         if density_percentage <=99.8:
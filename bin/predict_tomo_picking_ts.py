@@ -1,20 +1,18 @@
 #!/usr/bin/env python3
 import os, sys, logging, shutil, subprocess, time, math
-import glob
 import mrcfile
 import torch
 import numpy as np
-import scipy.cluster.hierarchy as hcluster
 
 from TomoNet.util.io import log
 from TomoNet.util.utils import mkfolder
+from TomoNet.util.toTile import tile_origins, iter_tiles, Stitcher
+from TomoNet.util.cluster import find_blocks, filter_patches
+from TomoNet.objects.tomogram_volume import TomogramVolume
+from TomoNet.util.device import get_device
 from TomoNet.preprocessing.cubes import normalize
 from TomoNet.util.searchParam import SearchParam 
 
-# used for extract sort keys
-def natural_keys(text, delimiter='_', index=-2):
-    return int(text.split(delimiter)[index])
-
 if __name__ == "__main__":
 
     start_time = time.time()
@@ -66,97 +64,58 @@ if __name__ == "__main__":
     os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"]=gpuID
 
-    if isinstance(gpuID, str):
+    # optional inference settings: CPU threads (used when no GPU is available), bfloat16 autocast and channels-last-3d memory format
+    ncpus = predict_params.predict_ncpus if hasattr(predict_params, "predict_ncpus") else None
+    use_bf16 = predict_params.use_bf16 if hasattr(predict_params, "use_bf16") else False
+    channels_last = predict_params.channels_last if hasattr(predict_params, "channels_last") else False
+    # tiles per forward pass, derived from the free device memory if not given
+    predict_batch_size = predict_params.predict_batch_size if hasattr(predict_params, "predict_batch_size") else None
+
+    gpuID_list = []
+    if isinstance(gpuID, str) and not gpuID.strip().lower() in ["cpu", "none", "-1", ""]:
         gpuID_list = list(map(int, gpuID.split(',')))
         
     gpu_device_count = torch.cuda.device_count()
-    if gpu_device_count == 0:
-        log(logger, "No available GPU detected, based on the requested GPU ID {}.".format(gpuID), "error")
-        sys.exit()
+    if len(gpuID_list) > 0 and gpu_device_count == 0:
+        log(logger, "No available GPU detected, based on the requested GPU ID {}. Run on CPU instead.".format(gpuID), "warning")
     elif len(gpuID_list) > gpu_device_count:
         log(logger, "No enough available GPUs ({} detected), based on the requested GPU ID {}. Available GPUs are:".format(gpu_device_count, gpuID), "error")
         for i in range(gpu_device_count):
             log(logger, torch.cuda.get_device_properties(i).name)
         sys.exit()
-    else:
-        log(logger, "Run training on {} GPU(s):".format(len(gpuID_list)))
-        for i in range(len(gpuID_list)):
-            log(logger, torch.cuda.get_device_properties(i).name)
-
-    # # read parameters
-    # params = sys.argv
-    # tomoName = sys.argv[1]
-    # result_dir = sys.argv[2]
-    # model_file = sys.argv[3]
-    # crop_size = int(sys.argv[4])
-    # cube_size = int(sys.argv[5])
-    # mask_file = sys.argv[6]
-    # repeat_unit = int(sys.argv[7])
-    # min_patch_size = int(sys.argv[8])
-    # y_label_size_predict = int(sys.argv[9])  
-    # tolerance = float(sys.argv[10])  
-    # save_seg_map = int(sys.argv[11])
-    
-    # #check whether running using terminal (12) or GUI (13) 
-    # if len(params) == 13:
-    #     log_file = params[12]
-    #     logger = logging.getLogger(__name__)
-    #     handler = logging.FileHandler(filename=log_file, mode='a')
-    #     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    #     handler.setFormatter(formatter)
-    #     formatter.datefmt = "%y-%m-%d %H:%M:%S"
-    #     logger.handlers = [handler]
-    #     logger.setLevel(logging.INFO)
-    # else:
-    #     logger = None
-
-    # set visiable gpus
 
+    device = get_device(gpuID, ncpus=ncpus, logger=logger)
 
-    # mode for output results for each patch (for debuging)
-    save_patch_MODE = False
-
+    # mode for output results for each patch, intermediate subtomograms and seg maps are also written to disk (for debuging)
+    save_patch_MODE = predict_params.debug_mode if hasattr(predict_params, "debug_mode") else False
 
     # create result folder
     if not os.path.exists(result_dir):
         os.mkdir(result_dir)
     
-    # data folder storing intermediate subtomograms
+    # data/predict folders storing intermediate subtomograms and seg maps, only used in debug mode
     data_dir = "{}/data".format(result_dir)
-    mkfolder(data_dir)
+    pred_dir = "{}/predict".format(result_dir)
+    if save_patch_MODE:
+        mkfolder(data_dir)
+        mkfolder(pred_dir)
 
     # get the current tomogram base name and read 3D volume
     log(logger, "######## Predicting tomogram {} ########".format(tomoName))
     baseName = tomoName.split('/')[-1].split('.')[0]
     
-    # read global input 3D volume
-    with mrcfile.open(tomoName) as mrcData:
-        orig_data = mrcData.data.astype(np.float32)
+    # global input 3D volume is memory-mapped, only the tiles to predict are paged in (and converted to float32)
+    orig_data = TomogramVolume(tomoName, permissive=False)
     
     # check if mask file used
     mask_data = None
     if not (mask_file == "None" or mask_file == None):
-        with mrcfile.open(mask_file) as m:
-                mask_data = m.data
+        mask_data = TomogramVolume(mask_file, permissive=False)
         log(logger, "######## Using mask file {} ########".format(mask_file))
 
     sp = np.array(orig_data.shape)
-
-    # margin related to overlaping region (pad_width) when extracting subtomograms
-    #margin_1 = (crop_size - cube_size)//2
-    #pad_width = (cube_size - (sp-2*margin_1)%cube_size)%cube_size//2
-    
-    # padded 3D volume data
-    #pad_orig_data = np.pad(orig_data, ((pad_width[0], pad_width[0]),(pad_width[1], pad_width[1]),(pad_width[2], pad_width[2])), 'mean')
-    #orig_data = pad_orig_data
-    #sp = np.array(orig_data.shape)
-    
-    # check if using mask
-    #if not (mask_file == "None" or mask_file == None):
-    #     mask_data = np.pad(mask_data, ((pad_width[0], pad_width[0]),(pad_width[1], pad_width[1]),(pad_width[2], pad_width[2])), 'constant')
     
     # number of cubes (x, y, z axis)
-    #sidelen = (sp-2*margin_1)//cube_size
     sidelen = (sp//cube_size) + 1
 
     # so, if no cube was detected, stop here 
@@ -164,47 +123,13 @@ if __name__ == "__main__":
         log(logger, "The crop size {} is larger than the dimension of input tomogram: {}.".format(crop_size, np.flip(sp)), level="error")
         sys.exit()
 
-    # crop starting coords (origin)
-    crop_start = 0
-
-    #prepare for extraction (get all subtomograms center locations)
-    count = 0
-    location_origins = "{}/location_origins.txt".format(result_dir)
-    location_origins_list = []
     log(logger, "Calculated subtomos #:{}".format(sidelen[0]*sidelen[1]*sidelen[2]))
 
-    # get subtomograms center coordinates
-    for i in range(sidelen[0]):
-        for j in range(sidelen[1]):
-            for k in range(sidelen[2]):
-
-                # boundaries of the current cube
-                z1,z2 = [i*cube_size, i*cube_size+crop_size]
-                y1,y2 = [j*cube_size, j*cube_size+crop_size]
-                x1,x2 = [k*cube_size, k*cube_size+crop_size]
-
-                if i==sidelen[0] - 1:
-                    z1,z2 = [sp[0]-crop_size, sp[0]]
-                if j==sidelen[1] - 1:
-                    y1,y2 = [sp[1]-crop_size, sp[1]]
-                if k==sidelen[2] - 1:
-                    x1,x2 = [sp[2]-crop_size, sp[2]]
-                
-                # if the current cube does not overlaping with the mask, skip it (this helps with exclude empty area to avoid false positive)
-                if not (mask_file == "None" or mask_file == None):
-                        if np.sum(mask_data[z1:z2, y1:y2, x1:x2]) <= 0:
-                            continue
-                
-                # extract cube from global map
-                cube = orig_data[z1:z2, y1:y2, x1:x2]
-                cube = normalize(cube)
-                
-                # write to disk
-                x_name = "{}/x_{}.mrc".format(data_dir, count)
-                with mrcfile.new(x_name, overwrite=True) as output_mrc:
-                    output_mrc.set_data(cube)
-                count+=1
-                location_origins_list.append([z1,y1,x1])
+    # get subtomograms origins, if a cube does not overlaping with the mask, skip it (this helps with exclude empty area to avoid false positive)
+    location_origins_list = tile_origins(sp, crop_size, cube_size, mask=mask_data)
+    count = len(location_origins_list)
+    if mask_data is not None:
+        mask_data.close()
 
     # only cube overlaping with mask will be used    
     log(logger, "Actual used subtomos #:{}".format(count))
@@ -214,47 +139,35 @@ if __name__ == "__main__":
         log(logger, "The crop size {} is and it is larger than the dimension of input tomogram: {}.".format(crop_size, np.flip(sp)), level="error")
         sys.exit()
 
-    # read all cube volume into memory
-    all_mrc_list = []
-    for it in glob.glob("{}/*".format(data_dir)):
-        all_mrc_list.append(it)
+    # cubes are normalized with their own percentiles ("tile"), or with the percentiles of the whole tomogram ("global", estimated once)
+    normalize_mode = predict_params.normalize_mode if hasattr(predict_params, "normalize_mode") else "tile"
+    global_stats = None
+    if normalize_mode == "global":
+        global_stats = (orig_data.percentile(4.0), orig_data.percentile(96.0))
+        log(logger, "global normalization percentiles (4, 96): {}".format(global_stats))
+
+    # normalized cubes are generated on the fly from the global map, nothing is written to disk unless in debug mode
+    def normalized_cubes():
+        for i, (cube, origin) in enumerate(iter_tiles(orig_data, location_origins_list, crop_size)):
+            cube = normalize(cube, stats=global_stats, in_place=True)
+            if save_patch_MODE:
+                with mrcfile.new("{}/x_{}.mrc".format(data_dir, i), overwrite=True) as output_mrc:
+                    output_mrc.set_data(cube)
+            yield cube, origin
 
     # load trained neural network
-    network = Net(filter_base = 64, out_channels=1)
+    network = Net(filter_base = 64, out_channels=1, logger=logger)
     network.load(model_file)
+    network.set_device(device, bf16=use_bf16, channels_last=channels_last)
 
-    # network inference for all the cubes
-    pred_dir = "{}/predict".format(result_dir)
-    mkfolder(pred_dir)
     log(logger,"trained_model={}".format(model_file))
     log(logger,"tolerance={}".format(tolerance))
-    network.predict(all_mrc_list[:], pred_dir, iter_count=0, inverted=False, filter_strength=tolerance, logger=logger)
-    log(logger,"Subtomogram Predict Done --- {} mins ---".format(round((time.time() - start_time)/60, 2)))
     
-    # Starting get coordinates info from the seg maps
-    start_time = time.time()
-    log(logger,"###### Start getting particles locations ######")
-    all_mrc_pred_list = []
-    for it in glob.glob("{}/*".format(pred_dir)):
-        if it.endswith(".mrc"):
-            all_mrc_pred_list.append(it)
-
-    # This is important, since the global location info for each cube is encoded in it's filename. Has to place back based on the number in the filename 
-    all_mrc_pred_list.sort(key=natural_keys)
-    
-    #global map initialization
-    global_map = np.ones(sp, dtype=np.float32)
-
-    # threshold for hierarchy cluster (min distance between two clusters)
-    thresh = 1.5
-
     # create result folder for current tomogram ( particle locations )
     tomoName_final = "{}_final".format(baseName)
     tomo_current_dir = "{}/{}".format(result_dir, tomoName_final)
     mkfolder(tomo_current_dir)
 
-    # for particle list 
-    particle_list = []
     # calculate the size of y labeling for each particle 
     mini_cube_size = (y_label_size_predict*2)+1
     
@@ -266,68 +179,61 @@ if __name__ == "__main__":
     #cube_activate_num = mini_cube_size**3*3/4
     cube_activate_num = y_label_size_predict**3*math.pi*4/3 *(0.5)
     log(logger, "cube_activate_num: {}".format(cube_activate_num))
+
+    # overlapping predictions are blended ('max', 'mean' or 'cosine') into one global probability map
+    stitch_mode = predict_params.stitch_mode if hasattr(predict_params, "stitch_mode") else "max"
+    log(logger, "stitch_mode={}".format(stitch_mode))
+    stitcher = Stitcher(sp, crop_size, mode=stitch_mode)
     
-    # handling each prediction seg map
-    for i in range(len(all_mrc_pred_list)):
-        pred = all_mrc_pred_list[i]
-        # get global coords of the current prediciton
-        ind = int(pred.split("_")[-2])
-        z_crop, y_crop, x_crop = location_origins_list[ind]
-
-        # read into memory
-        with mrcfile.open(pred) as mrc:
-            y_map = mrc.data[0]
-        
-        # in network.predict, only density with positive value will be considerred related to particles
-        points = np.argwhere(y_map > 0.1)
-        # filter based on the # of activated pixels
-        if points.shape[0] > cube_activate_num:
-            
-            # connected voxels will be clustered into the same particle (a block of voxels)
-            global_map[z_crop:z_crop+crop_size, y_crop:y_crop+crop_size, x_crop:x_crop+crop_size] = 63*y_map+1
-            clusters = hcluster.fclusterdata(points, thresh, criterion="distance")
-            
-            # for each block (particle), use the cluster center as the particle center. And this particle will be saved
-            for i in range(len(set(clusters))):
-                if points[np.argwhere(clusters == i+1)].shape[0] >= cube_activate_num:
-                    z,y,x = np.mean(points[np.argwhere(clusters == i+1)], axis=0)[0]
-                    #if x >=margin_1 and x <=crop_size-margin_1 and y >=margin_1 and y <=crop_size-margin_1 and z >=margin_1 and z <=crop_size-margin_1:
-                    #    particle_list.append([x+x_crop, y+y_crop, z+z_crop])
-                    particle_list.append([x+x_crop, y+y_crop, z+z_crop])
-    # So far, the raw paricles info is extracted from seg maps, but need to clean a little bit
-    
-    # First, remove duplication
-    particle_list = np.array(particle_list)
-    particle_list_rmdup = []
-    # particles within < unit distance * particle_dup_ratio > pixels will be considered as duplicates 
-    particle_dup_ratio = 0.75
-    log(logger, "Particle # before remove duplicates:{}".format(particle_list.shape[0]))
+    # network inference for all the cubes, each probability map is stitched into the global map right away
+    predictions = network.predict_cubes(normalized_cubes(), batch_size=predict_batch_size, filter_strength=None)
+    for ind, (pred, origin) in enumerate(predictions):
+        if save_patch_MODE:
+            with mrcfile.new("{}/x_{}_pred.mrc".format(pred_dir, ind), overwrite=True) as output_mrc:
+                output_mrc.set_data(pred)
+
+        if (ind+1) % 100 == 0 or ind+1 == count:
+            log(logger, "done {} out of {}".format(ind+1, count))
+
+        stitcher.add(pred[0], origin)
+    orig_data.close()
+
+    log(logger,"Subtomogram Predict Done --- {} mins ---".format(round((time.time() - start_time)/60, 2)))
     
-    if particle_list.shape[0] > 1:
-        # again use cluster method to achieve particle removal
-        clusters = hcluster.fclusterdata(particle_list, repeat_unit*particle_dup_ratio, criterion="distance")
-        log(logger, "Particle # after remove duplicates:{}".format(len(set(clusters))))
-        
-        for i in range(len(set(clusters))):
-                x,y,z = np.mean(particle_list[np.argwhere(clusters == i+1)], axis=0)[0]
-                particle_list_rmdup.append([x,y,z])
+    # Starting get coordinates info from the stitched map
+    start_time = time.time()
+    log(logger,"###### Start getting particles locations ######")
+
+    # only voxels with probability above the tolerance threshold will be considerred related to particles
+    seg_map = stitcher.result() >= 1/(10**tolerance)
+    del stitcher
+
+    # connected voxels will be grouped into the same particle (a block of voxels), only blocks with enough activated voxels are kept
+    # and the block center is used as the particle center. ('label': connected component labeling; 'hcluster': previous clustering, for checking)
+    cluster_method = predict_params.cluster_method if hasattr(predict_params, "cluster_method") else "label"
+    centers, block_sizes = find_blocks(seg_map, threshold=0.5, min_voxels=cube_activate_num, method=cluster_method)
+    particle_list = [[x, y, z] for z, y, x in centers]
+    log(logger, "Particle # detected:{}".format(len(particle_list)))
+
+    # blocks are detected once on the stitched map, no duplicates from overlapping cubes need to be removed
+    particle_list_rmdup = particle_list
     
     # Second, remove small lattices, which is likely to be false positive (for lattice-like particles)
     min_num_c = 0
     # patch count
     patch_c = 0
-    # unit_distance * patch_dis_ratio is the min distance for clusters when using hcluster.fclusterdata
+    # unit_distance * patch_dis_ratio is the max distance between neighboring particles of the same patch
     patch_dis_ratio = 1.25
     particle_list_rmdup = np.array(particle_list_rmdup)
     if particle_list_rmdup.shape[0] > 1:
         # global result
         with open("{}/{}/{}.pts".format(result_dir, tomoName_final, baseName),'w') as w:
-            # again, use hcluster (distance based) to perform clustering
-            clusters = hcluster.fclusterdata(particle_list_rmdup, repeat_unit*patch_dis_ratio, criterion="distance")
-            log(logger, "Detected patch #:{}".format(len(set(clusters))))
+            # again, use distance based clustering (single linkage) to group particles into patches
+            num_patches, patches = filter_patches(particle_list_rmdup, repeat_unit*patch_dis_ratio, min_patch_size)
+            log(logger, "Detected patch #:{}".format(num_patches))
             # check each particle cluster (i.e., lattice)
-            for i in range(len(set(clusters))):
-                neighbors = np.squeeze(particle_list_rmdup[np.argwhere(clusters == i+1)], axis=1)
+            for patch in patches:
+                neighbors = particle_list_rmdup[patch]
                 if len(neighbors) >= min_patch_size:
                     # patch result
                     with open("{}/{}/{}_patch_{}.pts".format(result_dir, tomoName_final, baseName, patch_c+1),'w') as wp:
@@ -357,7 +263,7 @@ if __name__ == "__main__":
     if save_seg_map == 1:
         global_map_filename = "{}/{}/predict.mrc".format(result_dir, tomoName_final)
         with mrcfile.new(global_map_filename, overwrite=True) as output_mrc:
-            output_mrc.set_data(global_map)
+            output_mrc.set_data(63*seg_map.astype(np.float32)+1)
 
     # create a link of mrc file #
     
@@ -372,12 +278,10 @@ if __name__ == "__main__":
         cmd_pts2mod = "point2model {} {} -sc -sp 3".format(pts_file, mod_file)
         subprocess.run(cmd_pts2mod, shell=True, encoding="utf-8")
 
-    # clean up intermediate results
-    if os.path.exists(pred_dir):
-        shutil.rmtree(pred_dir)
-    if os.path.exists("{}~".format(pred_dir)):
-        shutil.rmtree("{}~".format(pred_dir))
-    if os.path.exists(data_dir):
-        shutil.rmtree(data_dir)
+    # clean up intermediate results (left from previous runs), kept in debug mode
+    if not save_patch_MODE:
+        for folder in [pred_dir, "{}~".format(pred_dir), data_dir, "{}~".format(data_dir)]:
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
     log(logger, "Particles saved for {} --- {} mins ---".format(baseName, round((time.time() - start_time)/60, 2)))
     
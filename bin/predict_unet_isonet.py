@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
-import os, sys, logging, re
+import os, sys, logging, re, time, queue, threading
 #from TomoNet.util.image import *
 
 from TomoNet.util.metadata import MetaData, Label
 from TomoNet.util.dict2attr import idx2list
 from TomoNet.util.io import log
 from TomoNet.util.searchParam import SearchParam 
+from TomoNet.util.device import get_device, device_list, prefetch
 from TomoNet.models.network_isonet import Net 
 
 def check_gpu(gpu_ID, logger):
@@ -35,6 +36,30 @@ def check_params(args):
     if not hasattr(args, "batch_size"):
         args.batch_size = None
 
+    if not hasattr(args, "ncpus"):
+        args.ncpus = None
+
+    if not hasattr(args, "use_bf16"):
+        args.use_bf16 = False
+
+    if not hasattr(args, "channels_last"):
+        args.channels_last = False
+
+    # stop instead of falling back to CPU when the requested GPUs are not available
+    if not hasattr(args, "require_gpu"):
+        args.require_gpu = False
+
+    # run the network only on the cubes covered by the rlnMaskName mask of each tomogram (if any),
+    # the other cubes are filled with the input ("input") or its gaussian low-pass ("lowpass", sigma mask_fill_sigma)
+    if not hasattr(args, "use_mask"):
+        args.use_mask = True
+
+    if not hasattr(args, "mask_fill"):
+        args.mask_fill = "input"
+
+    if not hasattr(args, "mask_fill_sigma"):
+        args.mask_fill_sigma = 2.0
+
     return args
 
 def predict(args):
@@ -48,20 +73,40 @@ def predict(args):
     os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"]=args.gpuID
 
-    if not check_gpu(gpu_ID, logger):
-        sys.exit()
-    
     args = check_params(args)
 
+    # nodes without (enough) GPUs run the prediction on CPU, which is much slower: the fallback is reported
+    # with the requested and resolved devices, or refused if require_gpu is set
+    requested = args.gpuID
+    if args.gpuID.strip().lower() in ["cpu", "none", "-1", ""]:
+        args.gpuID = "cpu"
+    elif not check_gpu(gpu_ID, logger):
+        if args.require_gpu:
+            log(logger, "GPU(s) {} requested but not available, prediction stopped (require_gpu is set)".format(requested), "error")
+            return
+        args.gpuID = "cpu"
+    device = get_device(args.gpuID, ncpus=args.ncpus, logger=logger)
+    if args.gpuID == "cpu" and requested.strip().lower() not in ["cpu", "none", "-1", ""]:
+        log(logger, "GPU(s) {} requested but not available, prediction falls back to {} and will be much slower".format(requested, device), "warning")
+
     #log(logger, 'percentile: {}'.format(args.normalize_percentile))
     #log(logger, 'gpuID: {}'.format(args.gpuID))
 
-    network = Net(logger=logger)
-    #network.initialize()
-    network.load(args.model)
-
+    # one copy of the model per device (each visible GPU, otherwise the CPU threads), loaded once for all tomograms
+    devices = device_list(device)
+    args.ngpus = len(devices)
+    networks = []
+    for d in devices:
+        network = Net(logger=logger)
+        network.load(args.model)
+        network.set_device(d, bf16=args.use_bf16, channels_last=args.channels_last)
+        networks.append(network)
+
+    # each device predicts whole tomograms, batch_size is per device
     if args.batch_size is None:
-        args.batch_size = 4 * args.ngpus
+        args.batch_size = 4
+    else:
+        args.batch_size = max(1, args.batch_size // args.ngpus)
     
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
@@ -81,6 +126,8 @@ def predict(args):
     if md.size() == 0:
         log(logger, "No tomogram was detected in the provided star file: {}".format(args.star_file), "error")
         return
+
+    tasks = queue.Queue()
     for it in md:
         if args.tomo_idx is None or str(it.rlnIndex) in args.tomo_idx:
             if args.use_deconv_tomo and "rlnDeconvTomoName" in md.getLabels() and it.rlnDeconvTomoName not in [None,'None']:
@@ -90,11 +137,74 @@ def predict(args):
 
             tomo_root_name = os.path.splitext(os.path.basename(tomo_file))[0]
             
+            mask_file = None
+            if args.use_mask and "rlnMaskName" in md.getLabels() and it.rlnMaskName not in [None, 'None']:
+                if os.path.isfile(it.rlnMaskName):
+                    mask_file = it.rlnMaskName
+                else:
+                    log(logger, "mask {} cannot be found, predict the whole tomogram".format(it.rlnMaskName), "warning")
+
             if os.path.isfile(tomo_file):
                 tomo_out_name = '{}/{}_corrected.mrc'.format(args.output_dir, tomo_root_name)
-                network.predict_tomo(args, tomo_file, output_file=tomo_out_name)
-                md._setItemValue(it, Label('rlnCorrectedTomoName'), tomo_out_name)
-        md.write(args.star_file)
+                tasks.put((it, tomo_file, tomo_out_name, mask_file))
+            else:
+                log(logger, "tomogram {} cannot be found, skipped".format(tomo_file), "warning")
+
+    num_tomos = tasks.qsize()
+    log(logger, "Predict {} tomograms on {} device(s): {} (requested: {})".format(num_tomos, len(devices), ", ".join([str(d) for d in devices]), requested))
+
+    start_time = time.time()
+    done, errors = [], []
+    try:
+        threads = [threading.Thread(target=predict_worker, args=(network, tasks, args, done, errors)) for network in networks]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        # the star file is updated once, for the tomograms predicted successfully, and replaced atomically
+        for it, tomo_out_name in done:
+            md._setItemValue(it, Label('rlnCorrectedTomoName'), tomo_out_name)
+        md.write(args.star_file+"~")
+        os.replace(args.star_file+"~", args.star_file)
+
+    log(logger, "Predicted {} of {} tomograms --- {} mins ---".format(len(done), num_tomos, round((time.time() - start_time)/60, 2)))
+    if len(errors) > 0:
+        raise errors[0]
+
+def predict_worker(network, tasks, args, done, errors):
+    '''
+    predict tomograms taken from the tasks queue with network (on its own device) until the queue is empty.
+    the next tomogram is opened and its normalization statistics are computed in a background thread
+    while the current one is predicted
+    '''
+    logger = network.logger
+
+    def prepared():
+        while len(errors) == 0:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                return
+            start_time = time.time()
+            yield task, network.prepare_tomo(args, task[1]), time.time() - start_time
+
+    # prefetched tomograms that will not be predicted are closed
+    items = prefetch(prepared(), depth=1, discard=lambda item: item[1][0].close())
+    prepared_tomo = None
+    try:
+        for (it, tomo_file, tomo_out_name, mask_file), prepared_tomo, read_time in items:
+            predict_time = network.predict_tomo(args, tomo_file, output_file=tomo_out_name, mask_file=mask_file, prepared=prepared_tomo)
+            prepared_tomo = None
+            done.append((it, tomo_out_name))
+            log(logger, "{} on {}: read and normalize {:.1f} s, predict {:.1f} s".format(os.path.basename(tomo_file), network.device, read_time, predict_time))
+    except Exception as e:
+        log(logger, "prediction on {} failed: {}".format(network.device, e), "error")
+        errors.append(e)
+        if prepared_tomo is not None:
+            prepared_tomo[0].close()
+    finally:
+        items.close()
 
 if __name__ == "__main__":
 
@@ -9,6 +9,7 @@ from TomoNet.objects.tomogram import Tomogram
 from TomoNet.objects.expand import Expand
 from TomoNet.util.star_metadata import MetaData
 from TomoNet.util.utils import mkfolder
+from TomoNet.util.cluster import remove_duplicates, filter_patches
 from TomoNet.util.searchParam import SearchParam
 
 ########################
@@ -161,61 +162,34 @@ if os.path.exists(cache_folder_path):
             rotfile_one.close()
             rots = np.hstack((rots, rotfile_data[:]))
 
-import scipy.cluster.hierarchy as hcluster
 tomo.readTomo()
 search_param = SearchParam(param_file)
 repeat_unit = round(search_param.repeating_unit/tomo.apix, 1)
 particle_dup_ratio = 0.8
 patch_dis_ratio = 1.5
-#print(points)
-clusters = hcluster.fclusterdata(points, repeat_unit*particle_dup_ratio, criterion="distance")
-points_rmdup = []
-motls_rmdup = []
-rots_rmdup = []
-for i in range(len(set(clusters))):
-    neighbors = np.squeeze(points[np.argwhere(clusters == i+1)], axis=1)
-    if len(neighbors) > 1:
-        temp_motl = motls[np.argwhere(clusters == i+1)]
-        temp_motl = [motl_line[0].strip().split(',') for motl_line in temp_motl]
-        temp_motl = np.array([[float(it) for it in item] for item in temp_motl])
-        
-        ind = np.argwhere(temp_motl[:,0]==temp_motl.max(axis=0)[0])[0,0]
-        
-        x,y,z = points[np.argwhere(clusters == i+1)[ind][0]]
-        points_rmdup.append([x,y,z])
-        if len(motls_rmdup) == 0:
-            motls_rmdup = motls[np.argwhere(clusters == i+1)[ind][0]]
-            rots_rmdup = rots[np.argwhere(clusters == i+1)[ind][0]]
-        else:
-            motls_rmdup = np.hstack((motls_rmdup, motls[np.argwhere(clusters == i+1)[ind][0]]))
-            rots_rmdup = np.hstack((rots_rmdup, rots[np.argwhere(clusters == i+1)[ind][0]]))
-    else:
-        x,y,z = points[np.argwhere(clusters == i+1)][0,0]
-        points_rmdup.append([x,y,z])
-        if len(motls_rmdup) == 0:
-            motls_rmdup = motls[np.argwhere(clusters == i+1)[0,0]]
-            rots_rmdup = rots[np.argwhere(clusters == i+1)[0,0]]
-        else:
-            motls_rmdup = np.hstack((motls_rmdup, motls[np.argwhere(clusters == i+1)[0,0]]))
-            rots_rmdup = np.hstack((rots_rmdup, rots[np.argwhere(clusters == i+1)[0,0]]))
 
-points_rmdup = np.array(points_rmdup)
-clusters_2 = hcluster.fclusterdata(points_rmdup, repeat_unit*patch_dis_ratio, criterion="distance")
+def read_ccc(motl_line):
+    try:
+        return float(motl_line.split(',')[0])
+    except:
+        return 0
+
+# particles within repeat_unit*particle_dup_ratio are duplicates, the one with the highest CCC is kept
+ccc = np.array([read_ccc(motl_line) for motl_line in motls])
+keep = remove_duplicates(points, repeat_unit*particle_dup_ratio, scores=ccc)
+points_rmdup = points[keep]
+motls_rmdup = motls[keep]
+rots_rmdup = rots[keep]
+
+# group particles into patches and remove small patches
+_, patches = filter_patches(points_rmdup, repeat_unit*patch_dis_ratio, min_patch_size)
 points_patch = []
-motls_patch = []
-rots_patch = []
-patch_count = 0
-for i in range(len(set(clusters_2))):
-    neighbors = np.squeeze(points_rmdup[np.argwhere(clusters_2 == i+1)], axis=1)
-    if len(neighbors) >= min_patch_size:
-        patch_count+=1
-        [points_patch.append([patch_count, p[0][0],p[0][1],p[0][2]]) for p in points_rmdup[np.argwhere(clusters_2 == i+1)]]
-        if patch_count==1:
-            motls_patch = motls_rmdup[np.argwhere(clusters_2 == i+1)]
-            rots_patch = rots_rmdup[np.argwhere(clusters_2 == i+1)]
-        else:
-            motls_patch = np.vstack((motls_patch, motls_rmdup[np.argwhere(clusters_2 == i+1)]))
-            rots_patch = np.vstack((rots_patch, rots_rmdup[np.argwhere(clusters_2 == i+1)]))
+for patch_count, patch in enumerate(patches, 1):
+    points_patch.extend([[patch_count, p[0], p[1], p[2]] for p in points_rmdup[patch]])
+patch_count = len(patches)
+patch_ind = np.concatenate(patches) if patch_count > 0 else np.zeros(0, dtype=int)
+motls_patch = motls_rmdup[patch_ind]
+rots_patch = rots_rmdup[patch_ind]
        
 clean_pts_file = "{}/{}.pts".format(final_result_folder, tomo.tomoName)
 clean_mod_file = "{}/{}.mod".format(final_result_folder, tomo.tomoName)
@@ -227,7 +201,7 @@ with open(clean_pts_file,"w") as clean_pts_file_w:
         with open(clean_rotfile,"w") as frot:
             real_i = 0
             for i, coord in enumerate(points_patch):
-                motl_list = motls_patch[i][0].split(",")
+                motl_list = motls_patch[i].split(",")
                 try:
                     ccc = float(motl_list[0])
                 except:
@@ -237,7 +211,7 @@ with open(clean_pts_file,"w") as clean_pts_file_w:
                     clean_pts_file_w.write(" ".join([str(int(x)) for x in coord])+"\n")
                     motl_list[3] = str(real_i)
                     motl_line = ",".join(motl_list)
-                    rot_list = rots_patch[i][0]
+                    rot_list = rots_patch[i]
                     fmotl.write(motl_line)
                     frot.write(rot_list)
 
@@ -43,6 +43,10 @@ if __name__ == "__main__":
     ncpus = 8
     acc_batches = batch_size//2
 
+    # augmentation rotations are cycled through by default, or drawn at random (optionally seeded)
+    random_rotation = train_params.random_rotation if hasattr(train_params, "random_rotation") else False
+    rotation_seed = train_params.rotation_seed if hasattr(train_params, "rotation_seed") else None
+
     input_folder = train_params.input_folder_train
     tomoNameList = train_params.tomo_list
     
@@ -149,7 +153,8 @@ if __name__ == "__main__":
         metrics = network.train(data_dir, gpuID, 
                     learning_rate=lr, batch_size=batch_size,
                     epochs = iter_epoch_num, steps_per_epoch=steps_per_epoch, 
-                    acc_batches=acc_batches, ncpus=ncpus, enable_progress_bar=True, precision=16) 
+                    acc_batches=acc_batches, ncpus=ncpus, enable_progress_bar=True, precision=16,
+                    random_rotation=random_rotation, seed=rotation_seed) 
         
         metrics = metrics
         network.save('{}/model_iter_{:0>2d}.h5'.format(result_dir, star_iter + iter_epoch_num*(i+1)))
@@ -36,6 +36,8 @@ def check_params(args):
     #*******calculate parameters********
 
     args.data_dir = "{}/data".format(args.train_result_folder)
+    # wedge filtered original subtomos, computed in the first iteration and reused by the following ones
+    args.cache_dir = "{}/cache".format(args.train_result_folder)
 
     angle_1, angle_2 = args.tilt_range
 
@@ -220,14 +222,12 @@ if __name__ == "__main__":
             log(logger, "Done predicting subtomograms!")
 
         ### Noise settings ###
-        num_noise_volume = 1000
-        if num_iter >= train_params.noise_start_iter[0] and \
-                    (not os.path.isdir(train_params.noise_dir) or \
-                    len(os.listdir(train_params.noise_dir)) < num_noise_volume):
-            
-            from TomoNet.util.noise_generator import make_noise_folder
-            make_noise_folder(train_params.noise_dir, train_params.noise_mode, train_params.cube_size, \
-                                                num_noise_volume, ncpus=train_params.train_ncpu, logger=logger)
+        # one noise bank file (in noise_dir, unless noise_bank_dir is given), generated once and reused by later iterations
+        # and by other projects pointing to the same noise_bank_dir
+        if num_iter >= train_params.noise_start_iter[0]:
+            from TomoNet.util.noise_generator import make_noise_bank
+            bank_dir = train_params.noise_bank_dir if hasattr(train_params, "noise_bank_dir") else train_params.noise_dir
+            train_params.noise_bank = make_noise_bank(bank_dir, train_params.noise_mode, ncpus=train_params.train_ncpu, logger=logger)
              
         noise_level_series = get_noise_level(train_params.noise_level, train_params.noise_start_iter, train_params.train_iteration)
         train_params.noise_level_current =  noise_level_series[num_iter]
@@ -274,4 +274,8 @@ if __name__ == "__main__":
             network.predict(train_params.mrc_list, train_params.train_result_folder, train_params.iter_count)
             train_params.iter_count -=1 
 
+        ### the cache of wedge filtered subtomos is not needed after the last iteration ###
+        if num_iter == train_params.train_iteration and train_params.remove_intermediate is True:
+            shutil.rmtree(train_params.cache_dir, ignore_errors=True)
+
         log(logger, "Done Iteration #{}!".format(num_iter))
@@ -2,10 +2,12 @@ import os
 import mrcfile
 import torch
 import numpy as np
+from collections import OrderedDict
 
 from torch.utils.data.dataset import Dataset
 
 from TomoNet.preprocessing.cubes import normalize
+from TomoNet.preprocessing.shards import read_manifest, SHARD_FOLDER
 
 class Train_sets(Dataset):
     def __init__(self, data_dir, prefix = "train"):
@@ -52,6 +54,70 @@ class Train_sets_new(Dataset):
     def __len__(self):
         return len(self.path_all[0])
 
+# rotations keeping the missing wedge shape, as (k, axes) of np.rot90: original, 180 degree on X, Z and Y axis
+WEDGE_ROTATIONS = [(0, (0,1)), (2, (0,1)), (2, (1,2)), (2, (0,2))]
+
+class Train_sets_shards(Dataset):
+    '''
+    training pairs stored in .npy shards (see preprocessing/shards.py), the samples of subset prefix ("train" or "test")
+    are listed in the manifest. shards are memory-mapped on first use in each loader worker (at most max_open at a time),
+    a sample is a view into its shard until it is copied into the batch.
+    if the manifest asks for rotations, only the original cubes are stored and the first "rotations" of WEDGE_ROTATIONS
+    are applied on the fly: index i is rotation i % rotations of sample i // rotations, or a random rotation
+    (seeded per loader worker) if random_rotation is set. the length of an epoch stays samples * rotations either way
+    '''
+    def __init__(self, data_dir, prefix = "train", max_open = 64, random_rotation = False, seed = None):
+        super(Train_sets_shards, self).__init__()
+        manifest = read_manifest(data_dir)
+        self.folder = os.path.join(data_dir, SHARD_FOLDER)
+        self.shards = manifest["shards"]
+        self.offsets = np.cumsum([0] + [s["count"] for s in self.shards])
+        self.indices = np.array(manifest[prefix], dtype=np.int64)
+        self.rotations = WEDGE_ROTATIONS[:manifest.get("rotations", 1)]
+        self.random_rotation = random_rotation
+        self.seed = seed
+        self.max_open = max_open
+        self._maps = OrderedDict()
+        self._rng = None
+
+    def _shard(self, k):
+        if k in self._maps:
+            self._maps.move_to_end(k)
+        else:
+            if len(self._maps) >= self.max_open:
+                self._maps.popitem(last=False)
+            s = self.shards[k]
+            self._maps[k] = (np.load(os.path.join(self.folder, s["x"]), mmap_mode="r"),
+                             np.load(os.path.join(self.folder, s["y"]), mmap_mode="r"))
+        return self._maps[k]
+
+    def _rotation(self, idx):
+        if not self.random_rotation:
+            return idx % len(self.rotations)
+        if self._rng is None:
+            # each loader worker draws its own rotation stream
+            worker = torch.utils.data.get_worker_info()
+            self._rng = np.random.default_rng([self.seed if self.seed is not None else np.random.SeedSequence().entropy,
+                                               worker.id if worker is not None else 0])
+        return self._rng.integers(len(self.rotations))
+
+    def sample(self, idx):
+        # (x, y) views of sample idx of the subset, not rotated
+        i = self.indices[idx]
+        k = np.searchsorted(self.offsets, i, side="right") - 1
+        x, y = self._shard(k)
+        return x[i-self.offsets[k]], y[i-self.offsets[k]]
+
+    def __getitem__(self, idx):
+        rx, ry = self.sample(idx // len(self.rotations))
+        k, axes = self.rotations[self._rotation(idx)]
+        rx = torch.from_numpy(np.array(np.rot90(rx, k=k, axes=axes)[np.newaxis,:,:,:]))
+        ry = torch.from_numpy(np.array(np.rot90(ry, k=k, axes=axes)[np.newaxis,:,:,:]))
+        return rx, ry
+
+    def __len__(self):
+        return len(self.indices) * len(self.rotations)
+
 class Predict_sets(Dataset):
     def __init__(self, mrc_list, inverted=True):
         super(Predict_sets, self).__init__()
@@ -68,7 +134,11 @@ class Predict_sets(Dataset):
     def __len__(self):
         return len(self.mrc_list)
 
-def get_datasets(data_dir):
+def get_datasets(data_dir, random_rotation=False, seed=None):
+    # sharded data sets have a manifest, older ones one mrc file per sample in train_x/train_y/test_x/test_y
+    if read_manifest(data_dir) is not None:
+        return Train_sets_shards(data_dir, prefix="train", random_rotation=random_rotation, seed=seed), \
+                Train_sets_shards(data_dir, prefix="test")
     train_dataset = Train_sets_new(data_dir, prefix="train")
     val_dataset = Train_sets_new(data_dir, prefix="test")
     return train_dataset, val_dataset
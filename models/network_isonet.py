@@ -1,31 +1,59 @@
 
-import os, sys, time
+import os, sys, time, itertools
 import mrcfile
 from tqdm import tqdm
 import numpy as np
+from scipy.ndimage import binary_dilation, gaussian_filter
 
 import torch
 import pytorch_lightning as pl
 
 from .unet_isonet import Unet
 from .data_sequence import get_datasets, Predict_sets
-from TomoNet.preprocessing.cubes import normalize
+from TomoNet.preprocessing.cubes import normalize, estimate_percentiles, volume_moments
 #from rich.progress import track
-from TomoNet.util.toTile import reform3D
+from TomoNet.util.toTile import block_origins, iter_block_tiles, mask_occupancy, block_weight
 from TomoNet.util.io import log
+from TomoNet.util.device import get_device, inference_model, inference_context, to_device, prefetch
+from TomoNet.util.parallel import WriterPool
+from TomoNet.objects.tomogram_volume import TomogramVolume
 
 class Net:
     def __init__(self, metrics=None, logger = None):
         self.model = Unet(metrics=metrics)
         self.logger = logger
+        # inference settings, see set_device
+        self.device = None
+        self.bf16 = False
+        self.channels_last = False
+        self._inference_model = None
 
     def load(self, path):
-        checkpoint = torch.load(path)
+        # models trained on GPU can also be loaded on CPU only nodes
+        checkpoint = torch.load(path, map_location="cpu")
         self.model.load_state_dict(checkpoint)
+        self._inference_model = None
+
+    def set_device(self, device=None, bf16=False, channels_last=False):
+        # device used for inference (the best available one if None), with optional bfloat16 autocast and channels-last-3d memory format
+        self.device = device if device is not None else get_device(logger=self.logger)
+        self.bf16 = bf16
+        self.channels_last = channels_last
+        self._inference_model = None
+        return self.device
+
+    def inference_model(self):
+        # the model moved to the inference device, done once and reused by every predict call until load or set_device
+        if self.device is None:
+            self.set_device()
+        if self._inference_model is None:
+            self._inference_model = inference_model(self.model, self.device, self.channels_last)
+        return self._inference_model
 
     def load_jit(self, path):
         #Using the TorchScript format, you will be able to load the exported model and run inference without defining the model class.
         self.model = torch.jit.load(path)
+        self._inference_model = None
     
     def save(self, path):
         state = self.model.state_dict()
@@ -56,6 +84,8 @@ class Net:
                                                 pin_memory=True, num_workers=batch_size, drop_last=True)
 
         self.model.train()
+        # the trained model is moved to the inference device and set to eval mode again by the next predict
+        self._inference_model = None
 
         trainer = pl.Trainer(
             accumulate_grad_batches=acc_batches,
@@ -75,32 +105,53 @@ class Net:
         trainer.fit(self.model, train_loader, val_loader)        
         return self.model.metrics
 
-    def predict(self, mrc_list, result_dir, iter_count):    
+    def predict(self, mrc_list, result_dir, iter_count, write_workers=2):
+        # each batch of predictions is handed to a pool of writer threads while the next batch is inferred,
+        # the number of predictions waiting to be written is bounded by a few batches
 
+        batch_size = 4
         bench_dataset = Predict_sets(mrc_list)
-        bench_loader = torch.utils.data.DataLoader(bench_dataset, batch_size=4, num_workers=1)
+        bench_loader = torch.utils.data.DataLoader(bench_dataset, batch_size=batch_size, num_workers=1)
 
-        model = torch.nn.DataParallel(self.model.cuda())
-        model.eval()
+        model = self.inference_model()
+        device = self.device
 
-        predicted = []
+        def write_mrc(path, data):
+            with mrcfile.new(path, overwrite=True) as output_mrc:
+                output_mrc.set_data(data)
 
-        with torch.no_grad():
+        i = 0
+        with inference_context(device, self.bf16), WriterPool(workers=write_workers, max_pending=2*batch_size) as writer:
             for _, val_data in enumerate(bench_loader):
-                    res = model(val_data) 
-                    miu = res.cpu().detach().numpy().astype(np.float32)
-                    for item in miu:
-                        it = item.squeeze(0)
-                        predicted.append(it)
-        
-        for i, mrc in enumerate(mrc_list):
-            root_name = mrc.split('/')[-1].split('.')[0]
-            #outData = normalize(predicted[i], percentile = normalize_percentile)
-            with mrcfile.new('{}/{}_iter{:0>2d}.mrc'.format(result_dir, root_name, iter_count-1), overwrite=True) as output_mrc:
-                output_mrc.set_data(-predicted[i])
+                res = model(to_device(val_data, device, self.channels_last))
+                miu = res.float().cpu().numpy().astype(np.float32)
+                for item in miu:
+                    root_name = mrc_list[i].split('/')[-1].split('.')[0]
+                    #outData = normalize(predicted[i], percentile = normalize_percentile)
+                    writer.submit(write_mrc, '{}/{}_iter{:0>2d}.mrc'.format(result_dir, root_name, iter_count-1), -item.squeeze(0))
+                    i += 1
     
-    def predict_tomo(self, args, one_tomo, output_file=None):
+    def prepare_tomo(self, args, one_tomo):
+        '''
+        memory-map one tomogram and compute the normalization statistics of its negated values,
+        the input of predict_tomo. it does not use the network, so it can run in a background thread
+        while another tomogram is predicted
+        '''
+        orig_data = TomogramVolume(one_tomo, permissive=False)
+        max_samples = args.normalize_max_samples if hasattr(args, "normalize_max_samples") else 2**22
+        max_samples = max_samples if max_samples is not None else int(np.prod(orig_data.shape))
+
+        # statistics of the negated tomogram, every tile is normalized with them
+        if args.normalize_percentile:
+            stats = (-orig_data.percentile(96, max_samples), -orig_data.percentile(4, max_samples))
+        else:
+            stats = (-orig_data.mean(), orig_data.std())
+        return orig_data, stats
+
+    def predict_tomo(self, args, one_tomo, output_file=None, mask_file=None, prepared=None):
     #predict one tomogram in mrc format INPUT: mrc_file string OUTPUT: output_file(str) or <root_name>_corrected.mrc
+    #with a mask_file, only the cubes covered by the mask (and their neighbors, for blending) go through the network
+    #prepared is the output of prepare_tomo(args, one_tomo) if it was called ahead, returns the elapsed time (s)
 
         start_time = time.time()
 
@@ -114,42 +165,95 @@ class Net:
 
         log(self.logger, 'Predicting: {}'.format(root_name))
 
-        with mrcfile.open(one_tomo) as mrcData:
-            real_data = mrcData.data.astype(np.float32)*-1
-            voxelsize = mrcData.voxel_size
-
-        real_data = normalize(real_data, percentile=args.normalize_percentile)
-        data=np.expand_dims(real_data,axis=-1)
-        reform_ins = reform3D(data)
-        data = reform_ins.pad_and_crop_new(args.cube_size, args.crop_size)
+        # the tomogram is memory-mapped, tiles are cut from it on the fly (symmetric padding at the borders)
+        # and the block at the center of each predicted tile is written into the memory-mapped output
+        orig_data, stats = prepared if prepared is not None else self.prepare_tomo(args, one_tomo)
+        voxelsize = orig_data.voxel_size.copy()
+        sp = orig_data.shape
+        max_samples = args.normalize_max_samples if hasattr(args, "normalize_max_samples") else 2**22
+        max_samples = max_samples if max_samples is not None else int(np.prod(sp))
 
         N = args.batch_size
-        num_patches = data.shape[0]
-        if num_patches%N == 0:
-            append_number = 0
-        else:
-            append_number = N - num_patches%N
-        data = np.append(data, data[0:append_number], axis = 0)
-        num_big_batch = data.shape[0]//N
-        outData = np.zeros(data.shape)
+        cube_size = args.cube_size
+        origins = block_origins(sp, cube_size)
+        pad = (args.crop_size - cube_size)//2
+
+        # cubes outside the mask are filled from the input (or its low-pass), blended into the network output over one cube
+        occupancy, skipped = None, []
+        if mask_file is not None:
+            with TomogramVolume(mask_file) as mask:
+                if mask.shape != sp:
+                    log(self.logger, "mask {} {} does not match the tomogram {}, not used".format(mask_file, mask.shape, sp), "warning")
+                else:
+                    occupancy = mask_occupancy(mask.data, cube_size)
+        if occupancy is not None:
+            predicted = binary_dilation(occupancy, structure=np.ones((3,3,3), dtype=bool))
+            skipped = [o for o in origins if not predicted[o[0]//cube_size, o[1]//cube_size, o[2]//cube_size]]
+            origins = [o for o in origins if predicted[o[0]//cube_size, o[1]//cube_size, o[2]//cube_size]]
+            log(self.logger, "{} of {} cubes are covered by the mask, {} predicted with their neighbors".format(int(occupancy.sum()), len(origins)+len(skipped), len(origins)))
+        mask_fill = args.mask_fill if hasattr(args, "mask_fill") else "input"
+        mask_fill_sigma = args.mask_fill_sigma if hasattr(args, "mask_fill_sigma") else 2.0
+        fill_pad = min(pad, int(np.ceil(3*mask_fill_sigma))) if mask_fill == "lowpass" else 0
 
-        log(self.logger, "Total batches: {}".format(num_big_batch))
+        def fill(tile, tile_pad):
+            # (low-passed) center cube of a normalized tile
+            if mask_fill == "lowpass":
+                tile = gaussian_filter(tile, mask_fill_sigma)
+            return tile[tile_pad:tile_pad+cube_size, tile_pad:tile_pad+cube_size, tile_pad:tile_pad+cube_size]
 
-        model = torch.nn.DataParallel(self.model.cuda())
-        model.eval()
-        with torch.no_grad():
-            for i in tqdm(range(num_big_batch), file=sys.stdout):#track(range(num_big_batch), description="Processing..."):
-                in_data = torch.from_numpy(np.transpose(data[i*N:(i+1)*N],(0,4,1,2,3)))
-                output = model(in_data)
-                outData[i*N:(i+1)*N] = np.transpose(output.cpu().detach().numpy().astype(np.float32), (0,2,3,4,1) )
+        log(self.logger, "Total batches: {}".format(-(-len(origins)//N)))
 
-        outData = outData[0:num_patches]
+        def batches():
+            tiles = iter_block_tiles(orig_data.data, args.cube_size, args.crop_size, origins)
+            while True:
+                batch = list(itertools.islice(tiles, N))
+                if len(batch) == 0:
+                    return
+                data = np.stack([t for _, t in batch])[:, np.newaxis]
+                data *= -1
+                yield [o for o, _ in batch], normalize(data, percentile=args.normalize_percentile, stats=stats, in_place=True)
 
-        outData=reform_ins.restore_from_cubes_new(outData.reshape(outData.shape[0:-1]), args.cube_size, args.crop_size)
+        model = self.inference_model()
+        device = self.device
+        with mrcfile.new_mmap(output_file, shape=sp, mrc_mode=2, overwrite=True) as output_mrc:
+            outData = output_mrc.data
+            with inference_context(device, self.bf16):
+                for batch_origins, data in tqdm(prefetch(batches(), depth=2), total=-(-len(origins)//N), file=sys.stdout):
+                    output = model(to_device(data, device, self.channels_last)).float().cpu().numpy()
+                    for (z, y, x), cube, tile in zip(batch_origins, output[:, 0], data[:, 0]):
+                        block = outData[z:z+cube_size, y:y+cube_size, x:x+cube_size]
+                        bs = block.shape
+                        cube = cube[pad:pad+bs[0], pad:pad+bs[1], pad:pad+bs[2]]
+                        if occupancy is not None:
+                            weight = block_weight(occupancy, (z, y, x), cube_size, sp)
+                            if weight.min() < 1:
+                                cube = weight*cube + (1-weight)*fill(tile, pad)[:bs[0], :bs[1], :bs[2]]
+                        block[...] = cube
 
-        outData = normalize(outData,percentile=args.normalize_percentile)
-        with mrcfile.new(output_file, overwrite=True) as output_mrc:
-            output_mrc.set_data(-outData)
+            for (z, y, x), tile in iter_block_tiles(orig_data.data, cube_size, cube_size+2*fill_pad, skipped):
+                tile *= -1
+                tile = fill(normalize(tile, percentile=args.normalize_percentile, stats=stats, in_place=True), fill_pad)
+                block = outData[z:z+cube_size, y:y+cube_size, x:x+cube_size]
+                block[...] = tile[:block.shape[0], :block.shape[1], :block.shape[2]]
+            orig_data.close()
+
+            # normalize (and negate) the output slab by slab
+            if args.normalize_percentile:
+                out_stats = estimate_percentiles(outData, [4.0, 96.0], max_samples)
+            else:
+                out_stats = volume_moments(outData)
+            dmin, dmax, total, total_sq = np.inf, -np.inf, 0.0, 0.0
+            for z in range(0, sp[0], 64):
+                slab = normalize(np.array(outData[z:z+64]), percentile=args.normalize_percentile, stats=out_stats, in_place=True)
+                slab *= -1
+                outData[z:z+64] = slab
+                dmin, dmax = min(dmin, float(slab.min())), max(dmax, float(slab.max()))
+                total += float(slab.sum(dtype=np.float64))
+                total_sq += float(np.square(slab, dtype=np.float64).sum())
+            n = float(np.prod(sp))
+            output_mrc.header.dmin, output_mrc.header.dmax, output_mrc.header.dmean = dmin, dmax, total/n
+            output_mrc.header.rms = np.sqrt(max(total_sq/n - (total/n)**2, 0.0))
             output_mrc.voxel_size = voxelsize
 
-        log(self.logger, 'Done predicting {} --- {} mins ---'.format(root_name, round((time.time() - start_time)/60, 2)))
\ No newline at end of file
+        log(self.logger, 'Done predicting {} --- {} mins ---'.format(root_name, round((time.time() - start_time)/60, 2)))
+        return time.time() - start_time
\ No newline at end of file
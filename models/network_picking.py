@@ -1,23 +1,35 @@
-import mrcfile
+import mrcfile, time, itertools
 import numpy as np
 import torch
-import torch.nn as nn
 import pytorch_lightning as pl
 
 from .unet import Unet
 from .data_sequence import get_datasets, Predict_sets
 
 from TomoNet.util.io import log
+from TomoNet.util.device import get_device, inference_model, inference_context, to_device, SegmentationHead, auto_batch_size, prefetch
 
 class Net:
     def __init__(self,filter_base=64,out_channels=1, learning_rate = 3e-4, add_last=False, metrics=None,  logger = None):
         self.model = Unet(filter_base = filter_base,learning_rate=learning_rate, out_channels=out_channels, add_last=add_last, metrics=metrics)
         self.logger = logger
+        # inference settings, see set_device
+        self.device = None
+        self.bf16 = False
+        self.channels_last = False
 
     def load(self, path):
-        checkpoint = torch.load(path)
+        # models trained on GPU can also be loaded on CPU only nodes
+        checkpoint = torch.load(path, map_location="cpu")
         self.model.load_state_dict(checkpoint)
 
+    def set_device(self, device=None, bf16=False, channels_last=False):
+        # device used for inference (the best available one if None), with optional bfloat16 autocast and channels-last-3d memory format
+        self.device = device if device is not None else get_device(logger=self.logger)
+        self.bf16 = bf16
+        self.channels_last = channels_last
+        return self.device
+
     def load_jit(self, path):
         #Using the TorchScript format, you will be able to load the exported model and run inference without defining the model class.
         self.model = torch.jit.load(path)
@@ -33,7 +45,7 @@ class Net:
 
     def train(self, data_path, gpuID=[0,1,2,3], batch_size=None, 
               epochs = 10, steps_per_epoch=200, acc_batches =2,
-              ncpus=8, precision=32, learning_rate=3e-4, enable_progress_bar=True):
+              ncpus=8, precision=32, learning_rate=3e-4, enable_progress_bar=True, random_rotation=False, seed=None):
         
         self.model.learning_rate = learning_rate
 
@@ -45,7 +57,8 @@ class Net:
             train_batches = train_batches * acc_batches
             val_batches = val_batches * acc_batches
 
-        train_dataset, val_dataset = get_datasets(data_path)
+        # random_rotation: draw the augmentation rotation of each training sample at random (seeded) instead of cycling through all of them
+        train_dataset, val_dataset = get_datasets(data_path, random_rotation=random_rotation, seed=seed)
         train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True, persistent_workers=True,
                                                 num_workers=ncpus//2, pin_memory=True, drop_last=True)
 
@@ -82,53 +95,73 @@ class Net:
         trainer.fit(self.model, train_loader, val_loader)        
         return self.model.metrics
 
-    def predict(self, mrc_list, result_dir, iter_count, inverted=True, mw3d=None, batch_size=1, filter_strength=1.5, logger=None):    
-        full_size = 100
-        full_length = len(mrc_list)
-        iter = full_length//full_size
-        
-        if full_length%full_size == 0:
-            iter-=1
-        
-        for i in range(iter+1):
-            
-            if i == iter:
-                subset = mrc_list[i*full_size:] 
+    def predict(self, mrc_list, result_dir, iter_count, inverted=True, mw3d=None, batch_size=None, filter_strength=1.5, logger=None):    
+        '''
+        prediction of the subtomograms in mrc_list through predict_cubes, seg maps are written to result_dir.
+        subtomograms are read and normalized on the prefetch thread. if batch_size is None, it is derived from the free memory
+        '''
+        dataset = Predict_sets(mrc_list, inverted=inverted)
+        cubes = ((dataset[i][0], i) for i in range(len(mrc_list)))
+
+        for done, (seg_map, i) in enumerate(self.predict_cubes(cubes, batch_size=batch_size, filter_strength=filter_strength), 1):
+            root_name = mrc_list[i].split('/')[-1].split('.')[0]
+            if iter_count == 0:
+                file_name = '{}/{}_pred.mrc'.format(result_dir, root_name)
             else:
-                subset = mrc_list[i*full_size:(i+1)*full_size]
-
-            if i == iter or iter//4 == 0 or (i+1)%(iter//4) == 0:
-                log(logger, "done {} out of {}".format(i*full_size + len(subset), full_length))
-
-            bench_dataset = Predict_sets(subset, inverted=inverted)
-            bench_loader = torch.utils.data.DataLoader(bench_dataset, batch_size=batch_size, num_workers=1)
-
-            model = torch.nn.DataParallel(self.model.cuda())
-            model.eval()
-
-            predicted = []
-            with torch.no_grad():
-                for _, val_data in enumerate(bench_loader):
-                        res = model(val_data) 
-                        miu = res.cpu().detach().numpy().astype(np.float32)
-                        for item in miu:
-                            predicted.append(item)
-            
-            for i, mrc in enumerate(subset):
-                root_name = mrc.split('/')[-1].split('.')[0]
-
-                if iter_count == 0:
-                    file_name = '{}/{}_pred.mrc'.format(result_dir, root_name)
-                else:
-                    file_name = '{}/{}_iter{:0>2d}.mrc'.format(result_dir, root_name, iter_count-1)
-    
-                with mrcfile.new(file_name, overwrite=True) as output_mrc:
-                    temp = predicted[i]
-                    tensor_temp = torch.from_numpy(temp)
-                    temp = np.array(nn.Sigmoid()(tensor_temp))
-
-                    p = 1/(10**filter_strength)
-                    temp[temp < p] = 0
-                    temp[temp >= p] = 1
-
-                    output_mrc.set_data(temp)
\ No newline at end of file
+                file_name = '{}/{}_iter{:0>2d}.mrc'.format(result_dir, root_name, iter_count-1)
+
+            with mrcfile.new(file_name, overwrite=True) as output_mrc:
+                output_mrc.set_data(seg_map)
+            if done == len(mrc_list) or done%max(len(mrc_list)//4, 1) == 0:
+                log(logger, "done {} out of {}".format(done, len(mrc_list)))
+
+    def predict_cubes(self, cubes, batch_size=None, filter_strength=1.5, prefetch_batches=2):
+        '''
+        in-memory inference: cubes is an iterable of (cube, origin) pairs,
+        cubes are batched straight into the network and (seg_map, origin) is yielded for each of them
+        if filter_strength is None, the sigmoid probabilities are returned instead of the thresholded seg maps
+        batches are assembled on a background thread (prefetch_batches ahead), sigmoid and threshold run within the forward pass.
+        if batch_size is None, it is derived from the free memory
+        '''
+        device = self.device if self.device is not None else self.set_device()
+        threshold = None if filter_strength is None else 1/(10**filter_strength)
+        model = inference_model(SegmentationHead(self.model, threshold), device, self.channels_last)
+
+        cubes = iter(cubes)
+        first = next(cubes, None)
+        if first is None:
+            return
+        cubes = itertools.chain([first], cubes)
+        if batch_size is None:
+            batch_size = auto_batch_size(model, (1,) + np.shape(first[0]), device, self.bf16, self.channels_last)
+        log(self.logger, "batch size {}".format(batch_size))
+
+        def batches():
+            batch, origins = [], []
+            for cube, origin in cubes:
+                batch.append(np.asarray(cube, dtype=np.float32)[np.newaxis,:,:,:])
+                origins.append(origin)
+                if len(batch) == batch_size:
+                    yield self._stack_batch(batch, device), origins
+                    batch, origins = [], []
+            if len(batch) > 0:
+                yield self._stack_batch(batch, device), origins
+
+        num_tiles = 0
+        start = time.time()
+        for batch, origins in prefetch(batches(), depth=prefetch_batches):
+            with inference_context(device, self.bf16):
+                miu = model(to_device(batch, device, self.channels_last)).cpu().numpy()
+            if threshold is not None:
+                miu = miu.astype(np.float32)
+            num_tiles += len(origins)
+            yield from zip(miu, origins)
+
+        elapsed = time.time() - start
+        log(self.logger, "predicted {} tiles in {:.1f}s ({:.2f} tiles/s)".format(num_tiles, elapsed, num_tiles/max(elapsed, 1e-6)))
+
+    @staticmethod
+    def _stack_batch(batch, device):
+        # page-locked host memory allows asynchronous copies to the GPU
+        batch = torch.from_numpy(np.stack(batch))
+        return batch.pin_memory() if device.type == "cuda" else batch
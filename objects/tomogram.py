@@ -2,9 +2,9 @@ import os, subprocess
 import glob
 import imodmodel
 import numpy as np
-import scipy.cluster.hierarchy as hcluster
 
 from TomoNet.util.io import mkfolder
+from TomoNet.util.cluster import maxclust_clusters, cluster_members
 
 class Tomogram:
   def __init__(self, tomoName, tiltSeriesPath=None, rawtltPath=None, reconstructionPath=None, initialParamFolder=None, pickingPath=None, max_seed_num = 200):
@@ -73,10 +73,10 @@ class Tomogram:
     less_number = self.max_seed_num
     if os.path.exists(self.modPath):
       particle_list = np.array(imodmodel.read(self.modPath))[:,2:]
-      clusters = hcluster.fclusterdata(particle_list, t=less_number, criterion="maxclust")
-      new_particle_list = []
-      for i in range(len(set(clusters))):
-        new_particle_list.append(particle_list[np.argwhere(clusters == i+1)][0][0])
+      # one particle (the first one) for each of the less_number clusters
+      clusters = cluster_members(maxclust_clusters(particle_list, less_number))
+      seed_ind = [c[0] for c in clusters]
+      new_particle_list = particle_list[seed_ind]
 
     with open(less_ptsPath, "w") as f_pts:
       for p in new_particle_list:
@@ -98,8 +98,8 @@ class Tomogram:
       f_rot = open(self.rotaxesPath, "r")
       with open(less_rotaxesPath, "w") as f_rot_less:
         lines = np.array(f_rot.readlines())
-        for c in range(len(set(clusters))):
-          f_rot_less.write(lines[np.argwhere(clusters == c+1)][0][0])
+        for i in seed_ind:
+          f_rot_less.write(lines[i])
       self.rotaxesPath = less_rotaxesPath
     
     if use_motl_info:
@@ -111,8 +111,8 @@ class Tomogram:
         lines = f_motl.readlines()
         lines_no_header = np.array(lines[1:])
         f_motl_less.write(lines[0])
-        for c in range(len(set(clusters))):
-          new_line = lines_no_header[np.argwhere(clusters == c+1)][0][0]
+        for c, i in enumerate(seed_ind):
+          new_line = lines_no_header[i]
           new_line_split = new_line.split(',')
           new_line_split[3] = str(c+1)
 
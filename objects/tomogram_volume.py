@@ -0,0 +1,61 @@
+import mrcfile
+import numpy as np
+
+from TomoNet.preprocessing.cubes import estimate_percentiles, volume_moments
+
+class TomogramVolume:
+    '''
+    read-only, memory-mapped view of a tomogram (or mask) mrc file.
+    indexing returns float32 copies of the requested region only, so the full volume is never loaded or upcast as a whole.
+    global statistics are computed once and cached: mean and std slab by slab, percentiles from a random sample of voxels
+    '''
+    def __init__(self, path, permissive=True, slab_size=64):
+        self.path = path
+        self._mrc = mrcfile.mmap(path, mode='r', permissive=permissive)
+        self.data = self._mrc.data
+        self.header = self._mrc.header
+        self.voxel_size = self._mrc.voxel_size
+        self.shape = self.data.shape
+        self.ndim = self.data.ndim
+        self.slab_size = slab_size
+        self._stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, key):
+        return np.array(self.data[key], dtype=np.float32)
+
+    def close(self):
+        self.data = None
+        self._mrc.close()
+
+    def crop(self, center, size):
+        # float32 cube of side size centered at (z, y, x)
+        return self[tuple(slice(c-(size//2), c+size-(size//2)) for c in center)]
+
+    def slabs(self):
+        # (start, float32 slab) along z, slab_size slices at a time
+        for z in range(0, self.shape[0], self.slab_size):
+            yield z, self[z:z+self.slab_size]
+
+    def percentile(self, q, max_samples=2**22):
+        key = ("percentile", float(q), max_samples)
+        if key not in self._stats:
+            # estimated from a random sample of voxels, see estimate_percentiles for the error bound
+            self._stats[key] = float(estimate_percentiles(self.data, q, max_samples))
+        return self._stats[key]
+
+    def _moments(self):
+        if "moments" not in self._stats:
+            self._stats["moments"] = volume_moments(self.data, self.slab_size)
+        return self._stats["moments"]
+
+    def mean(self):
+        return self._moments()[0]
+
+    def std(self):
+        return self._moments()[1]
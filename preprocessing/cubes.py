@@ -1,50 +1,98 @@
 import sys
 import numpy as np
-import scipy.cluster.hierarchy as hcluster
 
 from TomoNet.util.io import log
 from TomoNet.util.geometry import in_boundary
+from TomoNet.util.cluster import maxclust_clusters
+
+def _sample_ranks(total, n):
+    '''
+    n random ranks in [0, total), the same distribution as np.random.choice(total, n, replace=total < n):
+    distinct and in random order if total >= n, drawn by rejection so memory is O(n) instead of O(total)
+    '''
+    if total == 0:
+        raise ValueError("no valid voxel to sample seeds from")
+    if total < n:
+        return np.random.randint(0, total, n)
+    if n > total//4:
+        return np.random.permutation(total)[:n]
+    ranks = np.zeros(0, dtype=np.int64)
+    while len(ranks) < n:
+        draws = np.concatenate([ranks, np.random.randint(0, total, 2*(n-len(ranks)))])
+        # keep the first occurrence of each rank, in drawing order
+        _, first = np.unique(draws, return_index=True)
+        ranks = draws[np.sort(first)]
+    return ranks[:n]
+
+def _mask_slabs(mask, border_slices, slab_size=32):
+    # (z, slab) of the mask inside border_slices, slab_size slices at a time
+    for z in range(border_slices[0].start, border_slices[0].stop, slab_size):
+        yield z, mask[z:min(z+slab_size, border_slices[0].stop), border_slices[1], border_slices[2]]
+
+def _masked_voxels(mask, border_slices, n, slab_size=32):
+    '''
+    n seeds sampled from the nonzero mask voxels inside border_slices, as np.where + np.random.choice would:
+    the voxels are counted slab by slab, ranks are sampled and then picked slab by slab, so no full size copy of the mask is made
+    '''
+    counts = [np.count_nonzero(m) for _, m in _mask_slabs(mask, border_slices, slab_size)]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    ranks = _sample_ranks(int(offsets[-1]), n)
+    which = np.searchsorted(offsets, ranks, side="right") - 1
+    inds = np.zeros((3, len(ranks)), dtype=np.int64)
+    for i, (z, m) in enumerate(_mask_slabs(mask, border_slices, slab_size)):
+        picked = np.flatnonzero(which == i)
+        if len(picked) == 0:
+            continue
+        local = np.unravel_index(np.flatnonzero(m)[ranks[picked] - offsets[i]], m.shape)
+        for j, (v, start) in enumerate(zip(local, (z, border_slices[1].start, border_slices[2].start))):
+            inds[j, picked] = v + start
+    return inds
 
 def create_cube_seeds(img3D, nCubesPerImg, cubeSideLen, mask=None):
+    '''
+    nCubesPerImg seeds drawn uniformly (without replacement if there are enough) from the voxels at least cubeSideLen//2
+    from the border, and inside the mask if given. memory is O(nCubesPerImg) without a mask, one slab of the mask otherwise
+    '''
     sp=img3D.shape
+    border_slices = tuple([slice(s // 2, d - s + s // 2 + 1) for s, d in zip((cubeSideLen,cubeSideLen,cubeSideLen), sp)])
     if mask is None:
-        cubeMask=np.ones(sp)
+        interior = tuple([max(s.stop - s.start, 0) for s in border_slices])
+        sample_inds = _sample_ranks(int(np.prod(interior)), nCubesPerImg)
+        rand_inds = [v + s.start for s, v in zip(border_slices, np.unravel_index(sample_inds, interior))]
     else:
-        cubeMask=mask
-    border_slices = tuple([slice(s // 2, d - s + s // 2 + 1) for s, d in zip((cubeSideLen,cubeSideLen,cubeSideLen), sp)])
-    valid_inds = np.where(cubeMask[border_slices])
-    valid_inds = [v + s.start for s, v in zip(border_slices, valid_inds)]
-    sample_inds = np.random.choice(len(valid_inds[0]), nCubesPerImg, replace=len(valid_inds[0]) < nCubesPerImg)
-    rand_inds = [v[sample_inds] for v in valid_inds]
+        rand_inds = _masked_voxels(mask, border_slices, nCubesPerImg)
     return (rand_inds[0], rand_inds[1], rand_inds[2])
 
 def create_cube_seeds_new(img3D, nCubesPerImg, cubeSideLen, coords, mask=None, logger=None):
+    '''
+    seeds near the particles: coords (x, y, z) are split into at most nCubesPerImg clusters, the first particle of each cluster
+    is randomly shifted (within cubeSideLen//2) and the candidates away from the border and inside the mask are sampled.
+    mask is a volume (kept where nonzero) or a function of (k, 3) zyx points returning a boolean array, only the candidate
+    voxels are looked up, so no full size volume is allocated
+    '''
     sp=img3D.shape
-    
-    if mask is None:
-        cubeMask=np.ones(sp)
-    else:
-        cubeMask=mask
     border_slices = tuple([slice(s // 2, d - s + s // 2 + 1) for s, d in zip((cubeSideLen,cubeSideLen,cubeSideLen), sp)])
-    coords = np.array(coords)
+    coords = np.array(coords).reshape(-1, 3)
     nCubesPerImg_cor = min(len(coords), nCubesPerImg)
-    clusters = hcluster.fclusterdata(coords, nCubesPerImg_cor, criterion="maxclust")
-    mask_coords = np.zeros(sp)
-    for i in range(len(set(clusters))):
-        x,y,z = coords[np.argwhere(clusters == i+1)][0][0]
-        #print('---',z,y,x)
-        
+    clusters = maxclust_clusters(coords, nCubesPerImg_cor)
+    _, first = np.unique(clusters, return_index=True)
+    candidates = []
+    for x,y,z in coords[first]:
         if in_boundary([z,y,x], sp, cubeSideLen//2):
             random_shifts = np.random.choice(cubeSideLen, 3) - cubeSideLen//2
             x,y,z = np.array([x,y,z]) + random_shifts
-        
-            x,y,z = [int(p) for p in [x,y,z]]
-            #print('+++',z,y,x)
-            mask_coords[z,y,x] = 1
-
-    merged_mask = np.multiply(cubeMask, mask_coords)
-    valid_inds = np.where(merged_mask[border_slices])
-    valid_inds = [v + s.start for s, v in zip(border_slices, valid_inds)]
+            candidates.append([int(z), int(y), int(x)])
+
+    # unique candidates in C order, same as np.where on a volume with the candidates set
+    candidates = np.unique(np.array(candidates, dtype=np.int64).reshape(-1, 3), axis=0)
+    inside = np.all([(candidates[:,i] >= s.start) & (candidates[:,i] < s.stop) for i, s in enumerate(border_slices)], axis=0)
+    candidates = candidates[inside]
+    if mask is not None and len(candidates) > 0:
+        if callable(mask):
+            candidates = candidates[np.asarray(mask(candidates), dtype=bool)]
+        else:
+            candidates = candidates[np.asarray(mask[candidates[:,0], candidates[:,1], candidates[:,2]]) != 0]
+    valid_inds = candidates.T
     if len(valid_inds[0]) == 0:
         log(logger, "Cannot generate subtomogram, possiable cause: 1. 'subtomo_box_size' ({}) is too large for the trained tomogram. 2. coordinates is not at the same binning scale with input tomograms".format(cubeSideLen), "error")
         return None
@@ -56,6 +104,27 @@ def create_cube_seeds_new(img3D, nCubesPerImg, cubeSideLen, coords, mask=None, l
 
     return (rand_inds[0], rand_inds[1], rand_inds[2])
 
+def in_particle_boxes(points, centers, cubeSideLen, shape, tree=None):
+    '''
+    whether each (z, y, x) point lies in the box of side cubeSideLen around any of the particle centers (x, y, z, tree of them if given),
+    boxes being clipped at the volume border the way extraction masks them. replaces the full size particle mask:
+    only the particles within cubeSideLen//2 (chebyshev) of each point are checked
+    '''
+    from scipy.spatial import cKDTree
+    half = cubeSideLen//2
+    centers = np.asarray(centers).reshape(-1, 3)
+    points = np.asarray(points).reshape(-1, 3)[:, ::-1]
+    if tree is None:
+        tree = cKDTree(centers)
+    sp = np.array(shape)[::-1]
+    low = np.where(centers > half, centers - half, 1)
+    high = np.where(centers < sp - half, centers + half, sp)
+    inside = np.zeros(len(points), dtype=bool)
+    for i, (p, near) in enumerate(zip(points, tree.query_ball_point(points, r=half, p=np.inf))):
+        if len(near) > 0:
+            inside[i] = np.any(np.all((low[near] <= p) & (p < high[near]), axis=1))
+    return inside
+
 def mask_mesh_seeds(mask, sidelen, croplen, threshold=0.01, indx=0):
     #indx = 0 take the even indix element of seed list,indx = 1 take the odd 
     # Count the masked points in the box centered at mesh grid point, if greater than threshold*sidelen^3, Take the grid point as seed.
@@ -63,13 +132,12 @@ def mask_mesh_seeds(mask, sidelen, croplen, threshold=0.01, indx=0):
     ni = [(i-croplen)//sidelen +1 for i in sp]
     margin = croplen//2 - sidelen//2
     ind_list =[]
+    # block sums of one row of blocks at a time (reshaped into sidelen^3 blocks) instead of one block at a time
     for z in range(ni[0]):
-        for y in range(ni[1]):
-            for x in range(ni[2]):
-                if np.sum(mask[margin+sidelen*z:margin+sidelen*(z+1),
-                margin+sidelen*y:margin+sidelen*(y+1),
-                margin+sidelen*x:margin+sidelen*(x+1)]) > sidelen**3*threshold:
-                    ind_list.append((margin+sidelen//2+sidelen*z, margin+sidelen//2+sidelen*y,
+        rows = np.asarray(mask[margin+sidelen*z:margin+sidelen*(z+1), margin:margin+sidelen*ni[1], margin:margin+sidelen*ni[2]], dtype=np.float64)
+        sums = rows.reshape(sidelen, ni[1], sidelen, ni[2], sidelen).sum(axis=(0, 2, 4))
+        for y, x in zip(*np.nonzero(sums > sidelen**3*threshold)):
+            ind_list.append((margin+sidelen//2+sidelen*z, margin+sidelen//2+sidelen*y,
                 margin+sidelen//2+sidelen*x))
     ind_list = ind_list[indx:-1:2]
     ind0 = [i[0] for i in ind_list]
@@ -78,24 +146,84 @@ def mask_mesh_seeds(mask, sidelen, croplen, threshold=0.01, indx=0):
     # return ind_list
     return (ind0,ind1,ind2)
 
-def normalize(x, percentile = True, pmin=4.0, pmax=96.0, axis=None, clip=False, eps=1e-20):
-    """Percentile-based image normalization."""
+def percentile_error(n_samples, alpha=0.001):
+    """Error bound (in percentile points) of percentiles estimated from n_samples random voxels.
+
+    By the Dvoretzky-Kiefer-Wolfowitz inequality, the estimate of percentile q lies between the true
+    percentiles q-e and q+e with probability at least 1-alpha, where e = 100*sqrt(ln(2/alpha)/(2*n_samples)).
+    """
+    return 100*np.sqrt(np.log(2/alpha)/(2*n_samples))
+
+def estimate_percentiles(x, q, max_samples=2**22, seed=0):
+    """Percentiles of x estimated from max_samples voxels drawn at random (with replacement).
+
+    Exact if x has no more than max_samples voxels, otherwise within percentile_error(max_samples),
+    about 0.1 percentile points with 99.9% confidence for the default 2**22 samples.
+    The samples are read in index order and only the sample is partitioned, so no copy of x is made
+    and a memory-mapped volume is only partly paged in.
+    """
+    flat = np.asarray(x).reshape(-1)
+    if flat.size <= max_samples:
+        return np.percentile(flat, q)
+    ind = np.sort(np.random.default_rng(seed).integers(0, flat.size, max_samples))
+    return np.percentile(flat[ind], q)
+
+def volume_moments(x, slab_size=64):
+    # (mean, std) of x accumulated in float64 slab by slab along the first axis, so a memory-mapped volume is never loaded as a whole
+    total, total_sq = 0.0, 0.0
+    for z in range(0, x.shape[0], slab_size):
+        slab = np.asarray(x[z:z+slab_size], dtype=np.float64)
+        total += slab.sum()
+        total_sq += np.square(slab).sum()
+    n = float(np.prod(x.shape))
+    mean = total/n
+    return mean, np.sqrt(max(total_sq/n - mean**2, 0.0))
+
+def normalize(x, percentile = True, pmin=4.0, pmax=96.0, axis=None, clip=False, eps=1e-20, max_samples=None, stats=None, in_place=False):
+    """Percentile-based image normalization.
+
+    max_samples: estimate the percentiles from that many random voxels (estimate_percentiles) instead of sorting a copy of x.
+    stats: precomputed (low, high) percentiles, or (mean, std) if percentile is False, e.g. of the whole tomogram when normalizing tiles.
+    in_place: scale a float32 x in place instead of allocating the output.
+    """
     if percentile:
-        mi = np.percentile(x,pmin,axis=axis,keepdims=True)
-        ma = np.percentile(x,pmax,axis=axis,keepdims=True)
-        out = (x - mi) / ( ma - mi + eps )
-        out = out.astype(np.float32)
+        if stats is not None:
+            mi, ma = stats
+        elif max_samples is not None and axis is None:
+            mi, ma = estimate_percentiles(x, [pmin, pmax], max_samples)
+        else:
+            mi = np.percentile(x,pmin,axis=axis,keepdims=True)
+            ma = np.percentile(x,pmax,axis=axis,keepdims=True)
+        if in_place and x.dtype == np.float32:
+            out = x
+            out -= mi
+            out /= ( ma - mi + eps )
+        else:
+            out = (x - mi) / ( ma - mi + eps )
+            out = out.astype(np.float32)
         if clip:
-            return np.clip(out, 0, 1)
+            return np.clip(out, 0, 1, out=out)
         else:
             return out
     else:
-        out = (x-np.mean(x))/np.std(x)
-        out = out.astype(np.float32)
+        mean, std = stats if stats is not None else (np.mean(x), np.std(x))
+        if in_place and x.dtype == np.float32:
+            out = x
+            out -= mean
+            out /= std
+        else:
+            out = (x-mean)/std
+            out = out.astype(np.float32)
         return out
 
-def normalize_global(x, percentile = True, pmin=1.0, pmax=99.0, axis=None, eps=1e-20, global_min=None, global_max=None):
+def normalize_global(x, percentile = True, pmin=1.0, pmax=99.0, axis=None, eps=1e-20, global_min=None, global_max=None, max_samples=None):
     """Percentile-based image normalization."""
+    if max_samples is not None and (global_min is None or global_max is None):
+        # both percentiles from one random sample, see estimate_percentiles
+        mi_est, ma_est = estimate_percentiles(x, [pmin, pmax], max_samples)
+        global_min = np.full((1,1,1), mi_est) if global_min is None else global_min
+        global_max = np.full((1,1,1), ma_est) if global_max is None else global_max
+
     if global_min is not None:
         mi = global_min
     else:
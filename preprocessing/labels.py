@@ -0,0 +1,61 @@
+import functools
+import numpy as np
+
+LABEL_KERNELS = ["diamond", "sphere", "cube", "gradient", "gaussian"]
+
+@functools.lru_cache(maxsize=None)
+def label_stamp(label_size, kernel="diamond"):
+    '''
+    particle label of side 2*label_size+1 (read only, cached per label_size and kernel)
+    "diamond": voxels within L1 distance label_size (pseudo sphere labeling)
+    "sphere": voxels within euclidean distance label_size
+    "cube": the whole cube (cubic labeling)
+    "gradient": soft label decreasing by 1/label_size for each step of chebyshev distance from the center
+    "gaussian": soft label exp(-r^2/(2*sigma^2)) with sigma = label_size/2, cut beyond distance label_size
+    '''
+    r = np.arange(-label_size, label_size+1)
+    z, y, x = np.meshgrid(r, r, r, indexing='ij')
+
+    if kernel == "diamond":
+        stamp = (np.abs(z) + np.abs(y) + np.abs(x) <= label_size).astype(np.float32)
+    elif kernel == "sphere":
+        stamp = (z**2 + y**2 + x**2 <= label_size**2).astype(np.float32)
+    elif kernel == "cube":
+        stamp = np.ones(z.shape, dtype=np.float32)
+    elif kernel == "gradient":
+        chebyshev = np.maximum(np.maximum(np.abs(z), np.abs(y)), np.abs(x))
+        stamp = (np.maximum(label_size - chebyshev, 0) / max(label_size, 1)).astype(np.float32)
+    elif kernel == "gaussian":
+        dist2 = z**2 + y**2 + x**2
+        sigma = max(label_size/2, 0.5)
+        stamp = (np.exp(-dist2/(2*sigma**2)) * (dist2 <= label_size**2)).astype(np.float32)
+    else:
+        raise ValueError("label kernel should be one of {}, got {}".format(LABEL_KERNELS, kernel))
+
+    stamp.setflags(write=False)
+    return stamp
+
+def paste_stamp(volume, stamp, center):
+    '''
+    paste stamp centered at (z, y, x) into volume (in place, keeping the maximum), clipped at the volume borders
+    '''
+    half = stamp.shape[0]//2
+    dst, src = [], []
+    for c, s in zip(center, volume.shape):
+        low, high = max(c-half, 0), min(c+half+1, s)
+        if low >= high:
+            return volume
+        dst.append(slice(low, high))
+        src.append(slice(low-(c-half), high-(c-half)))
+    np.maximum(volume[tuple(dst)], stamp[tuple(src)], out=volume[tuple(dst)])
+    return volume
+
+def render_labels(shape, centers, label_size, kernel="diamond"):
+    '''
+    float32 label volume with the stamp of kernel pasted at each (z, y, x) center
+    '''
+    volume = np.zeros(shape, dtype=np.float32)
+    stamp = label_stamp(label_size, kernel)
+    for c in centers:
+        paste_stamp(volume, stamp, c)
+    return volume
@@ -6,83 +6,140 @@ import numpy as np
 from functools import partial
 
 from TomoNet.preprocessing.cubes import normalize, create_cube_seeds, crop_cubes
-from TomoNet.preprocessing.simulate import apply_wedge, mw2d, apply_wedge_dcube
+from TomoNet.preprocessing.simulate import apply_wedge
 from TomoNet.util.metadata import rotation_list, MetaData, Item, Label
 from TomoNet.util.io import log
+from TomoNet.util.parallel import bounded_workers, tomogram_bytes, peak_memory
+from TomoNet.objects.tomogram_volume import TomogramVolume
+from TomoNet.preprocessing.shards import ShardWriter, merge_shards, split_shards
 
 #Make a new folder. If exist, nenew it
 # Do not set basic config for logging here
 # logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',datefmt="%H:%M:%S",level=logging.DEBUG)
 
+def extract_subtomos_one(tomo_file, mask_file, number_subtomo, crop_size, subtomo_dir, base_name, first_index=0):
+    '''
+    crop number_subtomo subtomos (seeded inside the mask, if any) from one tomogram
+    and save them as {subtomo_dir}/{base_name}_{index}.mrc, index starting from first_index.
+    returns the names of the saved subtomos
+    '''
+    orig_data = TomogramVolume(tomo_file)
+    mask = TomogramVolume(mask_file) if mask_file not in [None, "None"] else None
+
+    seeds=create_cube_seeds(orig_data, number_subtomo, crop_size, mask=mask.data if mask is not None else None)
+    subtomos=crop_cubes(orig_data, seeds, crop_size)
+    orig_data.close()
+    if mask is not None:
+        mask.close()
+
+    names = []
+    for j,s in enumerate(subtomos):
+        im_name = '{}/{}_{:0>6d}.mrc'.format(subtomo_dir, base_name, j+first_index)
+        with mrcfile.new(im_name, overwrite=True) as output_mrc:
+            output_mrc.set_data(s.astype(np.float32))
+        names.append(im_name)
+    return names
+
+def extraction_workers(tasks, ncpus=None):
+    '''
+    number of processes extracting the tasks (argument tuples of extract_subtomos_one) in parallel:
+    bounded by ncpus and by the memory needed for the largest tomogram (mask included) and its subtomos
+    '''
+    if len(tasks) == 0:
+        return 1
+    task_bytes = max([2*tomogram_bytes(t[0]) + 2*t[2]*t[3]**3*4 for t in tasks])
+    return bounded_workers(task_bytes, ncpus=ncpus, num_tasks=len(tasks))
+
+def run_extraction(tasks, num_workers=1, pool=None):
+    '''
+    extract_subtomos_one for each task, on pool (or a new pool of num_workers processes) if more than one worker is used.
+    returns the subtomo names of each task, in task order
+    '''
+    if pool is not None:
+        return pool.starmap(extract_subtomos_one, tasks)
+    if num_workers > 1:
+        # reseed numpy in each worker, otherwise forked workers draw the same seeds
+        with Pool(num_workers, initializer=np.random.seed) as p:
+            return p.starmap(extract_subtomos_one, tasks)
+    return [extract_subtomos_one(*t) for t in tasks]
+
+def write_subtomo_star(names_list, pixel_sizes, cube_size, crop_size, star_file):
+    '''
+    subtomo star file of the extracted subtomos, rlnSubtomoIndex numbered in task order
+    '''
+    subtomo_md = MetaData()
+    subtomo_md.addLabels('rlnSubtomoIndex','rlnImageName','rlnCubeSize','rlnCropSize','rlnPixelSize')
+    count=0
+    for names, pixel_size in zip(names_list, pixel_sizes):
+        for im_name in names:
+            count+=1
+            subtomo_it = Item()
+            subtomo_md.addItem(subtomo_it)
+            subtomo_md._setItemValue(subtomo_it,Label('rlnSubtomoIndex'), str(count))
+            subtomo_md._setItemValue(subtomo_it,Label('rlnImageName'), im_name)
+            subtomo_md._setItemValue(subtomo_it,Label('rlnCubeSize'),cube_size)
+            subtomo_md._setItemValue(subtomo_it,Label('rlnCropSize'),crop_size)
+            subtomo_md._setItemValue(subtomo_it,Label('rlnPixelSize'),pixel_size)
+    subtomo_md.write(star_file)
+    return count
+
 def extract_subtomos(settings):
     '''
     extract subtomo from whole tomogram based on mask
     and feed to generate_first_iter_mrc to generate xx_iter00.xx
+    tomograms are extracted in parallel (preprocessing_ncpus), the star file is written once all are done
     '''
     md = MetaData()
     md.read(settings.star_file)
     if len(md)==0:
         sys.exit("No input exists. Please check it in input folder!")
 
-    subtomo_md = MetaData()
-    subtomo_md.addLabels('rlnSubtomoIndex','rlnImageName','rlnCubeSize','rlnCropSize','rlnPixelSize')
-    count=0
+    tasks, pixel_sizes = [], []
     for it in md:
         if settings.tomo_idx is None or str(it.rlnIndex) in settings.tomo_idx:
-            pixel_size = it.rlnPixelSize
             if settings.use_deconv_tomo and "rlnDeconvTomoName" in md.getLabels() and os.path.isfile(it.rlnDeconvTomoName):
                 log(settings.logger, "Extract from deconvolved tomogram {}".format(it.rlnDeconvTomoName))
-                with mrcfile.open(it.rlnDeconvTomoName, permissive=True) as mrcData:
-                    orig_data = mrcData.data.astype(np.float32)
+                tomo_file = it.rlnDeconvTomoName
             else:        
                 print("Extract from origional tomogram {}".format(it.rlnMicrographName))
-                with mrcfile.open(it.rlnMicrographName, permissive =True) as mrcData:
-                    orig_data = mrcData.data.astype(np.float32)
-            
+                tomo_file = it.rlnMicrographName
 
             if "rlnMaskName" in md.getLabels() and it.rlnMaskName not in [None, "None"]:
-                with mrcfile.open(it.rlnMaskName, permissive=True) as m:
-                    mask_data = m.data
+                mask_file = it.rlnMaskName
             else:
-                mask_data = None
+                mask_file = None
                 log(settings.logger, " mask not been used for tomogram {}!".format(it.rlnIndex))
 
-            seeds=create_cube_seeds(orig_data, it.rlnNumberSubtomo, settings.crop_size,mask=mask_data)
-            subtomos=crop_cubes(orig_data,seeds,settings.crop_size)
-
             # save sampled subtomo to {results_dir}/subtomos instead of subtomo_dir (as previously does)
             base_name = os.path.splitext(os.path.basename(it.rlnMicrographName))[0]
-            
-            for j,s in enumerate(subtomos):
-                im_name = '{}/{}_{:0>6d}.mrc'.format(settings.subtomo_dir, base_name, j)
-                with mrcfile.new(im_name, overwrite=True) as output_mrc:
-                    count+=1
-                    subtomo_it = Item()
-                    subtomo_md.addItem(subtomo_it)
-                    subtomo_md._setItemValue(subtomo_it,Label('rlnSubtomoIndex'), str(count))
-                    subtomo_md._setItemValue(subtomo_it,Label('rlnImageName'), im_name)
-                    subtomo_md._setItemValue(subtomo_it,Label('rlnCubeSize'),settings.cube_size)
-                    subtomo_md._setItemValue(subtomo_it,Label('rlnCropSize'),settings.crop_size)
-                    subtomo_md._setItemValue(subtomo_it,Label('rlnPixelSize'),pixel_size)
-                    output_mrc.set_data(s.astype(np.float32))
-    subtomo_md.write(settings.subtomo_star)
+            tasks.append((tomo_file, mask_file, it.rlnNumberSubtomo, settings.crop_size, settings.subtomo_dir, base_name))
+            pixel_sizes.append(it.rlnPixelSize)
+
+    ncpus = settings.preprocessing_ncpus if hasattr(settings, "preprocessing_ncpus") else 1
+    names_list = run_extraction(tasks, extraction_workers(tasks, ncpus))
+    write_subtomo_star(names_list, pixel_sizes, settings.cube_size, settings.crop_size, settings.subtomo_star)
 
 def crop_to_size(array, crop_size, cube_size):
         start = crop_size//2 - cube_size//2
         end = crop_size//2 + cube_size//2
         return array[start:end, start:end, start:end]
 
-def get_cubes_one(data_X, data_Y, settings, start = 0, mask = None, add_noise = 0):
+def get_cubes_one(data_X, data_Y, settings, start = 0, mask = None, add_noise = 0, writer = None):
     '''
     crop out one subtomo and missing wedge simulated one from input data,
-    and save them as train set
+    and save them as train set (one sample of the shards of writer)
     '''
     #data_X = apply_wedge_dcube(data, mw)
     #data_Y = crop_to_size(data, settings.crop_size, settings.cube_size)
     #data_X = crop_to_size(apply_wedge_dcube(data, mw), settings.crop_size, settings.cube_size)
 
     if settings.noise_level_current > 0.0000001:
-        if settings.noise_dir is not None:
+        noise_bank = settings.noise_bank if hasattr(settings, "noise_bank") else None
+        if noise_bank is not None:
+            # random crop of the memory-mapped noise bank, the noise folder is not listed
+            from TomoNet.util.noise_generator import open_noise_bank
+            noise_volume = open_noise_bank(noise_bank).random_cube(data_X.shape[0])
+        elif settings.noise_dir is not None:
             path_noise = sorted([settings.noise_dir+'/'+f for f in os.listdir(settings.noise_dir)])
             path_index = np.random.randint(len(path_noise))
             def read_vol(f):
@@ -102,97 +159,119 @@ def get_cubes_one(data_X, data_Y, settings, start = 0, mask = None, add_noise =
         noise_volume = np.transpose(noise_volume, axes=(1,0,2))
         data_X += settings.noise_level_current * noise_volume / np.std(noise_volume)
 
-    with mrcfile.new('{}/train_x/x_{}.mrc'.format(settings.data_dir, start), overwrite=True) as output_mrc:
-        output_mrc.set_data(data_X.astype(np.float32))
-    with mrcfile.new('{}/train_y/y_{}.mrc'.format(settings.data_dir, start), overwrite=True) as output_mrc:
-        output_mrc.set_data(data_Y.astype(np.float32))
+    writer.add(data_X, data_Y)
     return 0
 
-def get_cubes(inp, settings):
+def wedged_subtomo(mrc, settings):
+    '''
+    normalized original subtomo with the missing wedge applied (the part of the training input that is the same in every iteration).
+    saved once in settings.cache_dir (if set) and loaded by later iterations, recomputed if the subtomo is newer than its cache
+    '''
+    cache_dir = settings.cache_dir if hasattr(settings, "cache_dir") else None
+    if cache_dir is not None:
+        root_name = mrc.split('/')[-1].split('.')[0]
+        mode = "percentile" if settings.train_normalize_percentile else "std"
+        cache_file = '{}/{}_wedged_{}.npy'.format(cache_dir, root_name, mode)
+        if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(mrc):
+            return np.load(cache_file)
+
+    with mrcfile.open(mrc, permissive=True) as mrcData:
+        iw_data = mrcData.data.astype(np.float32)*-1
+    iw_data = normalize(iw_data, percentile = settings.train_normalize_percentile)
+    iw_data = apply_wedge(iw_data, ld1 = 1, ld2=0)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file first, so a killed run never leaves a partial cache
+        with open(cache_file+"~", "wb") as f:
+            np.save(f, iw_data)
+        os.replace(cache_file+"~", cache_file)
+    return iw_data
+
+def get_cubes(inp, settings, writer):
     '''
     current iteration mrc(in the 'results') + infomation from orignal subtomo
     normalized predicted + normalized orig -> normalize
-    rotate by rotation_list and feed to get_cubes_one
+    rotate by rotation_list and feed to get_cubes_one, the samples are added to the shards of writer
     '''
     mrc, start = inp
     root_name = mrc.split('/')[-1].split('.')[0]
     current_mrc = '{}/{}_iter{:0>2d}.mrc'.format(settings.train_result_folder, root_name, settings.iter_count-1)
-    with mrcfile.open(mrc, permissive=True) as mrcData:
-        iw_data = mrcData.data.astype(np.float32)*-1
-    iw_data = normalize(iw_data, percentile = settings.train_normalize_percentile)
 
     with mrcfile.open(current_mrc, permissive=True) as mrcData:
         ow_data = mrcData.data.astype(np.float32)*-1
     ow_data = normalize(ow_data, percentile = settings.train_normalize_percentile)
 
-    orig_data = apply_wedge(ow_data, ld1=0, ld2=1) + apply_wedge(iw_data, ld1 = 1, ld2=0)
+    orig_data = apply_wedge(ow_data, ld1=0, ld2=1)
+    orig_data += wedged_subtomo(mrc, settings)
     #orig_data = ow_data
     orig_data = normalize(orig_data, percentile = settings.train_normalize_percentile)
 
-    rotated_data = np.zeros((len(rotation_list), *orig_data.shape))
-
     old_rotation = True
 
-    if old_rotation:
-        for i,r in enumerate(rotation_list):
+    # one rotation at a time in float32: rot90 views of orig_data, wedge applied (cached mw2d(crop_size) filter)
+    # and both volumes cropped to cube_size before they are written to the shard
+    for r in rotation_list:
+        if old_rotation:
             data = np.rot90(orig_data, k=r[0][1], axes=r[0][0])
             data = np.rot90(data, k=r[1][1], axes=r[1][0])
-            rotated_data[i] = data
-    else:
-        from scipy.ndimage import affine_transform
-        from scipy.stats import special_ortho_group 
-        for i in range(len(rotation_list)):
+        else:
+            from scipy.ndimage import affine_transform
+            from scipy.stats import special_ortho_group 
             rot = special_ortho_group.rvs(3)
             center = (np.array(orig_data.shape) -1 )/2.
             offset = center-np.dot(rot,center)
-            rotated_data[i] = affine_transform(orig_data,rot,offset=offset)
-    
-    mw = mw2d(settings.crop_size)   
-    datax = apply_wedge_dcube(rotated_data, mw)
+            data = affine_transform(orig_data,rot,offset=offset,output=np.float32)
 
-    for i in range(len(rotation_list)): 
-        data_X = crop_to_size(datax[i], settings.crop_size, settings.cube_size)
-        data_Y = crop_to_size(rotated_data[i], settings.crop_size, settings.cube_size)
-        get_cubes_one(data_X, data_Y, settings, start = start) 
+        data_X = crop_to_size(apply_wedge(data, ld1=1, ld2=0), settings.crop_size, settings.cube_size)
+        data_Y = crop_to_size(data, settings.crop_size, settings.cube_size)
+        get_cubes_one(data_X, data_Y, settings, start = start, writer = writer) 
         start += 1#settings.ncube
 
+def get_cubes_batch(batch, settings):
+    '''
+    get_cubes of a batch of (mrc, start) inputs, all written to the shards of one writer named after the batch index.
+    returns the peak memory of the process
+    '''
+    index, inps = batch
+    side = 2*(settings.cube_size//2)
+    with ShardWriter(settings.data_dir, "{:0>4d}".format(index), (side, side, side)) as writer:
+        for inp in inps:
+            get_cubes(inp, settings, writer)
+    return peak_memory()
+
 def get_cubes_list(settings):
     '''
     generate new training dataset:
     map function 'get_cubes' to mrc_list from subtomo_dir
     seperate 10% generated cubes into test set.
     '''    
-    dirs_tomake = ['train_x','train_y', 'test_x', 'test_y']
     if not os.path.exists(settings.data_dir):
         os.makedirs(settings.data_dir)
-    for d in dirs_tomake:
-        folder = '{}/{}'.format(settings.data_dir, d)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
     inp=[]
     for i, mrc in enumerate(settings.mrc_list):
         inp.append((mrc, i*len(rotation_list)))
     
     # inp: list 0f (mrc_dir, index * rotation times)
 
-    if settings.train_ncpu > 1:
-        func = partial(get_cubes, settings=settings)
-        with Pool(settings.train_ncpu) as p:
-            p.map(func, inp)
+    # one batch of subtomograms per worker, each batch written into a few large shards
+    num_batches = max(min(settings.train_ncpu, len(inp)), 1)
+    batches = [(k, inp[k*len(inp)//num_batches:(k+1)*len(inp)//num_batches]) for k in range(num_batches)]
+    if num_batches > 1:
+        func = partial(get_cubes_batch, settings=settings)
+        with Pool(num_batches) as p:
+            peaks = p.map(func, batches)
     else:
-        for i in inp:
-            log(settings.logger, "{}".format(i))
-            get_cubes(i, settings)
+        peaks = [get_cubes_batch(b, settings) for b in batches]
+    if len(peaks) > 0 and max(peaks) > 0:
+        log(settings.logger, "peak memory per worker generating training cubes: {:.1f} MB".format(max(peaks)/1024**2))
 
-    all_path_x = os.listdir(settings.data_dir+'/train_x')
-    num_test = int(len(all_path_x) * 0.1) 
+    # collect the shards of all batches, the test set is an index list of the manifest (no file is moved)
+    manifest = merge_shards(settings.data_dir)
+    num_test = int(manifest["count"] * 0.1) 
     num_test = num_test + num_test%settings.ngpus
     #num_test = num_test - num_test%settings.ngpus + settings.ngpus
-    all_path_y = ['y_'+i.split('_')[1] for i in all_path_x ]
-    ind = np.random.permutation(len(all_path_x))[0:num_test]
-    for i in ind:
-        os.rename('{}/train_x/{}'.format(settings.data_dir, all_path_x[i]), '{}/test_x/{}'.format(settings.data_dir, all_path_x[i]) )
-        os.rename('{}/train_y/{}'.format(settings.data_dir, all_path_y[i]), '{}/test_y/{}'.format(settings.data_dir, all_path_y[i]) )
+    split_shards(settings.data_dir, num_test)
 
 def get_noise_level(noise_level_tuple, noise_start_iter_tuple, iterations):
     assert len(noise_level_tuple) == len(noise_start_iter_tuple) and type(noise_level_tuple) in [tuple,list]
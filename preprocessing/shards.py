@@ -0,0 +1,113 @@
+import os, json
+import numpy as np
+
+SHARD_FOLDER = "shards"
+MANIFEST = "manifest.json"
+
+class ShardWriter:
+    '''
+    write fixed-shape (x, y) training pairs into memory-mapped .npy shards of shard_size samples,
+    instead of two mrc files per sample. shards are preallocated (sparse files), the number of samples
+    actually written in each is recorded in the part manifest {name}.json on close.
+    parts written by several writers (tomograms, processes) are merged into the data set manifest by merge_shards
+    '''
+    def __init__(self, data_dir, name, shape, shard_size=256, dtype=np.float32):
+        self.folder = os.path.join(data_dir, SHARD_FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+        self.name = name
+        self.shape = tuple(int(s) for s in shape)
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.shards = []
+        self._x = None
+        self._y = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum([s["count"] for s in self.shards])
+
+    def _new_shard(self):
+        k = len(self.shards)
+        names = ["{}_{}_{:0>4d}.npy".format(self.name, c, k) for c in ["x", "y"]]
+        shape = (self.shard_size,) + self.shape
+        self._x = np.lib.format.open_memmap(os.path.join(self.folder, names[0]), mode="w+", dtype=self.dtype, shape=shape)
+        self._y = np.lib.format.open_memmap(os.path.join(self.folder, names[1]), mode="w+", dtype=self.dtype, shape=shape)
+        self.shards.append({"x": names[0], "y": names[1], "count": 0})
+
+    def _flush(self):
+        if self._x is not None:
+            self._x.flush()
+            self._y.flush()
+            self._x, self._y = None, None
+
+    def add(self, x, y):
+        if self._x is None or self.shards[-1]["count"] == self.shard_size:
+            self._flush()
+            self._new_shard()
+        i = self.shards[-1]["count"]
+        self._x[i] = x
+        self._y[i] = y
+        self.shards[-1]["count"] += 1
+
+    def close(self):
+        self._flush()
+        part = {"shape": list(self.shape), "dtype": self.dtype.name, "shards": self.shards}
+        with open(os.path.join(self.folder, "{}.json".format(self.name)), "w") as f:
+            json.dump(part, f)
+
+def read_manifest(data_dir):
+    # the data set manifest, None if data_dir does not hold sharded data
+    path = os.path.join(data_dir, MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(data_dir, manifest):
+    # written to a temporary file first, so readers never see a partial manifest
+    path = os.path.join(data_dir, MANIFEST)
+    with open(path+"~", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path+"~", path)
+
+def merge_shards(data_dir, rotations=1):
+    '''
+    merge the part manifests of all writers (sorted by name) into the data set manifest,
+    all samples are in the train subset until split_shards is called.
+    rotations > 1 asks the data set to apply that many wedge preserving rotations on the fly (see Train_sets_shards)
+    '''
+    folder = os.path.join(data_dir, SHARD_FOLDER)
+    parts = sorted([f for f in os.listdir(folder) if f.endswith(".json")])
+    shape, dtype, shards = None, None, []
+    for p in parts:
+        with open(os.path.join(folder, p)) as f:
+            part = json.load(f)
+        if len(part["shards"]) == 0:
+            continue
+        if shape is None:
+            shape, dtype = part["shape"], part["dtype"]
+        elif part["shape"] != shape or part["dtype"] != dtype:
+            raise ValueError("shards of {} have shape {} ({}), expected {} ({})".format(p, part["shape"], part["dtype"], shape, dtype))
+        shards.extend([s for s in part["shards"] if s["count"] > 0])
+    count = sum([s["count"] for s in shards])
+    manifest = {"shape": shape, "dtype": dtype, "count": count, "rotations": rotations, "shards": shards, "train": list(range(count)), "test": []}
+    write_manifest(data_dir, manifest)
+    for p in parts:
+        os.remove(os.path.join(folder, p))
+    return manifest
+
+def split_shards(data_dir, num_test):
+    '''
+    move num_test random samples into the test subset. only the index lists of the manifest change, no file is moved
+    '''
+    manifest = read_manifest(data_dir)
+    ind = np.random.permutation(manifest["count"])
+    manifest["test"] = sorted([int(i) for i in ind[:num_test]])
+    manifest["train"] = sorted([int(i) for i in ind[num_test:]])
+    write_manifest(data_dir, manifest)
+    return manifest
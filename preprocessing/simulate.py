@@ -1,97 +1,99 @@
-
 #!/usr/bin/env python
 # encoding: utf-8
+import functools
 import numpy as np
+import scipy.fft
 
 def mw2d(dim, missingAngle=[30,30]):
-    mw=np.zeros((dim,dim),dtype=np.double)
-    missingAngle = np.array(missingAngle)
-    missing=np.pi/180*(90-missingAngle)
-    for i in range(dim):
-        for j in range(dim):
-            y=(i-dim/2)
-            x=(j-dim/2)
-            if x==0:# and y!=0:
-                theta=np.pi/2
-            #elif x==0 and y==0:
-            #    theta=0
-            #elif x!=0 and y==0:
-            #    theta=np.pi/2
-            else:
-                theta=abs(np.arctan(y/x))
+    '''
+    missing wedge mask (dim x dim, centered) of the (z, x) plane, 1 where the Fourier components are measured.
+    masks are cached per (dim, missingAngle) and returned read only
+    '''
+    return _mw2d(int(dim), tuple(float(a) for a in np.ravel(missingAngle)))
 
-            if x**2+y**2<=min(dim/2,dim/2)**2:
-                if x > 0 and y > 0 and theta < missing[0]:
-                    mw[i,j]=1#np.cos(theta)
-                if x < 0 and y < 0 and theta < missing[0]:
-                    mw[i,j]=1#np.cos(theta)
-                if x > 0 and y < 0 and theta < missing[1]:
-                    mw[i,j]=1#np.cos(theta)
-                if x < 0 and y > 0 and theta < missing[1]:
-                    mw[i,j]=1#np.cos(theta)
+@functools.lru_cache(maxsize=None)
+def _mw2d(dim, missingAngle):
+    missing=np.pi/180*(90-np.array(missingAngle))
+    y = (np.arange(dim) - dim/2)[:, np.newaxis]
+    x = (np.arange(dim) - dim/2)[np.newaxis, :]
+    # theta is pi/2 on the x = 0 column
+    ratio = np.divide(np.abs(y), np.abs(x), out=np.zeros((dim, dim)), where=(x != 0))
+    theta = np.where(x == 0, np.pi/2, np.arctan(ratio))
 
-            if int(y) == 0:
-                mw[i,j]=1
-    #from mwr.util.image import norm_save
-    #norm_save('mw.tif',self._mw)
+    same_sign = ((x > 0) & (y > 0)) | ((x < 0) & (y < 0))
+    opposite_sign = ((x > 0) & (y < 0)) | ((x < 0) & (y > 0))
+    mw = (x**2 + y**2 <= (dim/2)**2) & ((same_sign & (theta < missing[0])) | (opposite_sign & (theta < missing[1])))
+    # the central row (int(y) == 0) is always kept
+    mw = (mw | (np.trunc(y) == 0)).astype(np.double)
+    mw.setflags(write=False)
     return mw
 
+def mw3d(dim, missingAngle=[30,30]):
+    '''
+    missing wedge mask of a (z, y, x) cube, mw2d of the (z, x) plane repeated along y (cached, read only)
+    '''
+    return _mw3d(int(dim), tuple(float(a) for a in np.ravel(missingAngle)))
 
-#import tensorflow as tf
-def apply_wedge_dcube(ori_data, mw2d, mw3d=None):
-    if mw3d is None:
-        #if len(ori_data.shape) > 3:
-        #    ori_data = np.squeeze(ori_data, axis=-1)
-        data = np.rot90(ori_data, k=1, axes=(1,2)) #clock wise of counter clockwise??
-        data = np.fft.ifft2(np.fft.fftshift(mw2d)[np.newaxis, np.newaxis, :, :] * np.fft.fft2(data))
-        #data = tf.signal.ifft2d(np.fft.fftshift(mw2d)[np.newaxis, np.newaxis, :, :] * tf.signal.fft2d(data))
-        data = np.real(data)
-        data=np.rot90(data, k=3, axes=(1,2))
-
-    else:
-        import mrcfile
-        with mrcfile.open(mw3d, permissive=True) as mrc:
-            mw = mrc.data
-        mwshift = np.fft.fftshift(mw)
-        data = np.zeros_like(ori_data)
-        for i,d in enumerate(ori_data):
-            f_data = np.fft.fftn(d)
-            outData = mwshift*f_data
-            inv = np.fft.ifftn(outData)
-            data[i] = np.real(inv).astype(np.float32)
-            #data[i] = normalize(data[i],percentile=True)
+@functools.lru_cache(maxsize=8)
+def _mw3d(dim, missingAngle):
+    mw = np.ascontiguousarray(np.broadcast_to(_mw2d(dim, missingAngle)[:, np.newaxis, :], (dim, dim, dim)))
+    mw.setflags(write=False)
+    return mw
 
-    return data
+def _rfft_filter(mask):
+    '''
+    rfftn filter (float32, last axis halved) of a centered mask: fftshifted and made point symmetric,
+    so that irfftn(filter * rfftn(x)) == real(ifftn(fftshift(mask) * fftn(x))) for real x
+    '''
+    shifted = np.fft.fftshift(mask)
+    mirrored = np.roll(shifted[(slice(None, None, -1),)*shifted.ndim], 1, axis=tuple(range(shifted.ndim)))
+    filt = ((shifted + mirrored)/2)[..., :shifted.shape[-1]//2+1].astype(np.float32)
+    filt.setflags(write=False)
+    return filt
 
-def apply_wedge(ori_data, ld1 = 1, ld2 =0, mw3d = None, missingAngle=[30,30]):
+@functools.lru_cache(maxsize=32)
+def wedge_filter(dim, missingAngle=(30,30), ld1=1, ld2=0):
+    # rfftn filter of mw2d * ld1 + (1-mw2d) * ld2 over the (z, x) axes, cached
+    mw = mw2d(dim, missingAngle)
+    return _rfft_filter(mw * ld1 + (1-mw) * ld2)
 
-    if mw3d is None:
-        data = np.rot90(ori_data, k=1, axes=(0,1)) #clock wise of counter clockwise??
-        
-        mw = mw2d(data.shape[1], missingAngle)
-
-        #if inverse:
-        #    mw = 1-mw
-        mw = mw * ld1 + (1-mw) * ld2
+@functools.lru_cache(maxsize=4)
+def _read_mw3d(mw3d_file):
+    import mrcfile
+    with mrcfile.open(mw3d_file, permissive=True) as mrc:
+        mw = np.array(mrc.data, dtype=np.float32)
+    mw.setflags(write=False)
+    return mw
 
-        outData = np.zeros(data.shape,dtype=np.float32)
-        mw_shifted = np.fft.fftshift(mw)
-        for i, item in enumerate(data):
-            outData_i=np.fft.ifft2(mw_shifted * np.fft.fft2(item))
-            outData[i] = np.real(outData_i)
+def _filter(data, filt, axes, workers=None):
+    # one batched real FFT over axes of data (float32 / complex64), multiplied by filt broadcast over the other axes
+    data = np.asarray(data, dtype=np.float32)
+    shape = [1]*data.ndim
+    for a, n in zip(axes, filt.shape):
+        shape[a] = n
+    f_data = scipy.fft.rfftn(data, axes=axes, workers=workers)
+    f_data *= filt.reshape(shape)
+    return scipy.fft.irfftn(f_data, s=[data.shape[a] for a in axes], axes=axes, overwrite_x=True, workers=workers).astype(np.float32, copy=False)
 
-        outData.astype(np.float32)
-        outData=np.rot90(outData, k=3, axes=(0,1))
-        return outData
+#import tensorflow as tf
+def apply_wedge_dcube(ori_data, mw2d, mw3d=None, workers=None):
+    '''
+    apply the missing wedge to a stack of cubes (n, z, y, x): mw2d on the (z, x) planes, or the 3D mask read from the mw3d file.
+    the whole stack is filtered by one batched rfftn, in float32
+    '''
+    if mw3d is None:
+        return _filter(ori_data, _rfft_filter(mw2d), axes=(1,3), workers=workers)
     else:
-        import mrcfile
-        with mrcfile.open(mw3d, permissive=True) as mrc:
-            mw = mrc.data
-        mw = np.fft.fftshift(mw)
-        mw = mw * ld1 + (1-mw) * ld2
+        return _filter(ori_data, _rfft_filter(_read_mw3d(mw3d)), axes=(1,2,3), workers=workers)
 
-        f_data = np.fft.fftn(ori_data)
-        outData = mw*f_data
-        inv = np.fft.ifftn(outData)
-        outData = np.real(inv).astype(np.float32)
-    return outData
\ No newline at end of file
+def apply_wedge(ori_data, ld1 = 1, ld2 =0, mw3d = None, missingAngle=[30,30], workers=None):
+    '''
+    keep the Fourier components inside the missing wedge mask (weight ld1) and outside of it (weight ld2) of a (z, y, x) volume,
+    the mask being mw2d of the (z, x) plane or the 3D mask read from the mw3d file. returns float32
+    '''
+    if mw3d is None:
+        filt = wedge_filter(ori_data.shape[0], tuple(np.ravel(missingAngle)), ld1, ld2)
+        return _filter(ori_data, filt, axes=(0,2), workers=workers)
+    else:
+        mw = _read_mw3d(mw3d)
+        return _filter(ori_data, _rfft_filter(mw * ld1 + (1-mw) * ld2), axes=(0,1,2), workers=workers)
@@ -1,66 +1,18 @@
 import os, time, logging
-import mrcfile
 import numpy as np
+import multiprocessing
 
 from PyQt5.QtCore import QThread
 
 from TomoNet.util.dict2attr import idx2list
 from TomoNet.util.io import mkfolder
-from TomoNet.util.metadata import MetaData, Label, Item
-from TomoNet.preprocessing.cubes import create_cube_seeds, crop_cubes
-
-def mw2d(dim,missingAngle=[30,30]):
-    mw=np.zeros((dim,dim),dtype=np.double)
-    missingAngle = np.array(missingAngle)
-    missing=np.pi/180*(90-missingAngle)
-    for i in range(dim):
-        for j in range(dim):
-            y=(i-dim/2)
-            x=(j-dim/2)
-            if x==0:# and y!=0:
-                theta=np.pi/2
-            #elif x==0 and y==0:
-            #    theta=0
-            #elif x!=0 and y==0:
-            #    theta=np.pi/2
-            else:
-                theta=abs(np.arctan(y/x))
-
-            if x**2+y**2<=min(dim/2,dim/2)**2:
-                if x > 0 and y > 0 and theta < missing[0]:
-                    mw[i,j]=1#np.cos(theta)
-                if x < 0 and y < 0 and theta < missing[0]:
-                    mw[i,j]=1#np.cos(theta)
-                if x > 0 and y < 0 and theta < missing[1]:
-                    mw[i,j]=1#np.cos(theta)
-                if x < 0 and y > 0 and theta < missing[1]:
-                    mw[i,j]=1#np.cos(theta)
-
-            if int(y) == 0:
-                mw[i,j]=1
-    #from mwr.util.image import norm_save
-    #norm_save('mw.tif',self._mw)
-    return mw
+from TomoNet.util.metadata import MetaData
+from TomoNet.preprocessing.prepare import extraction_workers, run_extraction, write_subtomo_star
+from TomoNet.preprocessing import simulate
 
 def apply_wedge(ori_data, missingAngle, ld1 = 1, ld2 = 0):
-
-    data = np.rot90(ori_data, k=1, axes=(0,1)) #clock wise of counter clockwise??
-    mw = mw2d(data.shape[1], missingAngle)
-
-    #if inverse:
-    #    mw = 1-mw
-    mw = mw * ld1 + (1-mw) * ld2
-
-    outData = np.zeros(data.shape,dtype=np.float32)
-    mw_shifted = np.fft.fftshift(mw)
-    for i, item in enumerate(data):
-        outData_i=np.fft.ifft2(mw_shifted * np.fft.fft2(item))
-        outData[i] = np.real(outData_i)
-
-    outData.astype(np.float32)
-    outData=np.rot90(outData, k=3, axes=(0,1))
-
-    return outData
+    # cached wedge mask and batched rfftn, see preprocessing/simulate.py
+    return simulate.apply_wedge(ori_data, ld1=ld1, ld2=ld2, missingAngle=missingAngle)
 
 def split_data(data_dir):    
     # hyper-parameters
@@ -93,6 +45,9 @@ class ExtractSubtomos(QThread):
         self.cube_size = d['subtomo_cube_size']
         self.crop_size = self.cube_size + 16
         self.tomo_index_subtomo =  d['tomo_index_subtomo']
+        # processes extracting tomograms in parallel (all cores if not given, bounded by memory)
+        self.ncpus = d['ncpus'] if 'ncpus' in d else None
+        self.pool = None
         self.use_deconv_subtomo = d['use_deconv_subtomo']
 
         self.log_file = "IsoNet/isonet.log"
@@ -129,10 +84,7 @@ class ExtractSubtomos(QThread):
 
         tomo_idx = idx2list(self.tomo_index_subtomo)
 
-        subtomo_md = MetaData()
-        subtomo_md.addLabels('rlnSubtomoIndex','rlnImageName','rlnCubeSize','rlnCropSize','rlnPixelSize')
-
-        count = 0
+        tasks, pixel_sizes = [], []
         for it in md:
             if tomo_idx is None or str(it.rlnIndex) in tomo_idx:
                 if self.use_deconv_subtomo == 1:
@@ -144,60 +96,48 @@ class ExtractSubtomos(QThread):
                 else:
                     tomo_file = it.rlnMicrographName
                 
-                pixel_size = it.rlnPixelSize
-                
-                if os.path.exists(tomo_file):
+                if os.path.isfile(tomo_file):
                     self.logger.info("Extracting from tomogram {}".format(tomo_file))
-                    with mrcfile.open(tomo_file, permissive=True) as mrcData:
-                        orig_data = mrcData.data.astype(np.float32)
                 else:
                     self.logger.warning("Tomogram {} does not exist. Perhaps it was removed by accident. Skip extraction this one!".format(tomo_file))
                     continue
 
-                #tomo_root_name = os.path.splitext(os.path.basename(tomo_file))[0]
-                #self.logger.info(tomo_root_name)
-                
-                if os.path.isfile(tomo_file):  
-                    #if mask is None:
-                    if "rlnMaskName" in md.getLabels() and it.rlnMaskName not in [None, "None"]:
-                        with mrcfile.open(it.rlnMaskName, permissive=True) as m:
-                            mask_data = m.data
-                        self.logger.info('mask is been used for tomogram #{}.'.format(it.rlnIndex))
-                    else:
-                        mask_data = None
-                        self.logger.info(" mask is not been used for tomogram #{}!".format(it.rlnIndex))
-
-                    seeds = create_cube_seeds(orig_data, it.rlnNumberSubtomo, self.crop_size, mask=mask_data)
-                    subtomos = crop_cubes(orig_data, seeds, self.crop_size)
-
-                    # save sampled subtomo to {results_dir}/subtomos instead of subtomo_dir (as previously does)
-                    base_name = os.path.splitext(os.path.basename(it.rlnMicrographName))[0]
-                    
-                    for j, s in enumerate(subtomos):
-                        im_name_x = '{}/{}_{:0>6d}.mrc'.format(self.subtomo_folder, base_name, j+1)
-                        #im_name_x = '{}/{}/{}_x_{}.mrc'.format(self.subtomo_folder, dirs_tomake[0], base_name, j)
-
-                        with mrcfile.new(im_name_x, overwrite=True) as output_mrc:
-                            count += 1
-                            subtomo_it = Item()
-                            subtomo_md.addItem(subtomo_it)
-                            subtomo_md._setItemValue(subtomo_it,Label('rlnSubtomoIndex'), str(count))
-                            subtomo_md._setItemValue(subtomo_it,Label('rlnImageName'), im_name_x)
-                            subtomo_md._setItemValue(subtomo_it,Label('rlnCubeSize'), self.cube_size)
-                            subtomo_md._setItemValue(subtomo_it,Label('rlnCropSize'), self.crop_size)
-                            subtomo_md._setItemValue(subtomo_it,Label('rlnPixelSize'), pixel_size)
-                            
-                            output_mrc.set_data(s.astype(np.float32))
+                if "rlnMaskName" in md.getLabels() and it.rlnMaskName not in [None, "None"]:
+                    mask_file = it.rlnMaskName
+                    self.logger.info('mask is been used for tomogram #{}.'.format(it.rlnIndex))
                 else:
-                    self.logger.warning('Tomogram map {} was not detected.'.format(tomo_file))
-                
-            subtomo_md.write(self.subtomo_star)
+                    mask_file = None
+                    self.logger.info(" mask is not been used for tomogram #{}!".format(it.rlnIndex))
+
+                # save sampled subtomo to {results_dir}/subtomos instead of subtomo_dir (as previously does)
+                base_name = os.path.splitext(os.path.basename(it.rlnMicrographName))[0]
+                tasks.append((tomo_file, mask_file, it.rlnNumberSubtomo, self.crop_size, self.subtomo_folder, base_name, 1))
+                pixel_sizes.append(it.rlnPixelSize)
+
+        # tomograms are extracted in parallel, the subtomo star file is numbered in tomogram order once all are done
+        num_workers = extraction_workers(tasks, self.ncpus)
+        self.logger.info("Extract {} tomograms with {} worker(s)".format(len(tasks), num_workers))
+        if num_workers > 1:
+            # workers are spawned, forking the multithreaded GUI process can deadlock.
+            # numpy is reseeded in each worker, so that workers never draw the same seeds
+            self.pool = multiprocessing.get_context("spawn").Pool(num_workers, initializer=np.random.seed)
+            try:
+                names_list = run_extraction(tasks, pool=self.pool)
+            finally:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        else:
+            names_list = run_extraction(tasks)
+        write_subtomo_star(names_list, pixel_sizes, self.cube_size, self.crop_size, self.subtomo_star)
 
         self.logger.info( "Extraction Done --- {} mins ---".format(round((time.time() - start_time)/60, 2)))
 
         #split_data(self.subtomo_folder)
     
     def stop_process(self):
+        if self.pool is not None:
+            self.pool.terminate()
         self.terminate()
         self.quit()
         self.wait()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import gc
+import functools
 import mrcfile
 import scipy.fft
 import numpy as np
@@ -41,67 +42,59 @@ def wiener1d(angpix, voltage, cs, defocus, snrfalloff, deconvstrength, highpassn
     wiener = ctf/(ctf*ctf+1/snr)
     return ctf, wiener
 
-def tom_deconv_tomo(vol_file, out_file,angpix, voltage, cs, defocus, snrfalloff, deconvstrength, highpassnyquist, phaseflipped, phaseshift, ncpu=8):
-    with mrcfile.open(vol_file, permissive=True) as f:
-        header_in = f.header
-        vol = f.data
-        voxelsize = f.voxel_size
+def wiener_ramp(shape, angpix, voltage, cs, defocus, snrfalloff, deconvstrength, highpassnyquist, phaseflipped, phaseshift):
+    '''
+    wiener filter of a (z, y, x) volume of shape on the rfftn grid (last axis halved), float32 and read only.
+    the radial frequency is summed from 1D axes broadcast slice by slice, without full meshgrids.
+    see cached_wiener_ramp for chunks
+    '''
     data = np.arange(0,1+1/2047.,1/2047.)
     highpass = np.minimum(np.ones(data.shape[0]), data/highpassnyquist) * np.pi
     highpass = 1-np.cos(highpass)
     eps = 1e-6
     snr = np.exp(-data * snrfalloff * 100 / angpix) * (10**deconvstrength) * highpass + eps
-    #snr[0] = -1
     ctf = tom_ctf1d(angpix*1e-10, voltage * 1e3, cs * 1e-3, -defocus*1e-6, 0.07, phaseshift / 180 * np.pi, 0)
     if phaseflipped:
         ctf = abs(ctf)
-
     wiener = ctf/(ctf*ctf+1/snr)
 
-    denom = ctf*ctf+1/snr
-    #np.savetxt('den.txt',denom)
-    #np.savetxt('snr.txt',snr)
-    #np.savetxt('hipass.txt',highpass)
-    #np.savetxt('ctf.txt',ctf)
-    #np.savetxt('wiener.txt',wiener, fmt='%f')
-
-    s1 = - int(np.shape(vol)[1] / 2)
-    f1 = s1 + np.shape(vol)[1] - 1
-    m1 = np.arange(s1,f1+1)
-
-    s2 = - int(np.shape(vol)[0] / 2)
-    f2 = s2 + np.shape(vol)[0] - 1
-    m2 = np.arange(s2,f2+1)
-
-    s3 = - int(np.shape(vol)[2] / 2)
-    f3 = s3 + np.shape(vol)[2] - 1
-    m3 = np.arange(s3,f3+1)
-
-#s3 = -floor(size(vol,3)/2);
-#f3 = s3 + size(vol,3) - 1;
-    x, y, z = np.meshgrid(m1,m2,m3)
-    x = x.astype(np.float32) / np.abs(s1)
-    y = y.astype(np.float32) / np.abs(s2)
-    z = z.astype(np.float32) / np.maximum(1, np.abs(s3))
-    #z = z.astype(float) / np.abs(s3);
-    r = np.sqrt(x**2+y**2+z**2)
-    del x,y,z
-    gc.collect()
-    r = np.minimum(1, r)
-    r = np.fft.ifftshift(r)
-
-    #x = 0:1/2047:1;
-    ramp = np.interp(r, data,wiener).astype(np.float32)
-    del r
-    gc.collect()
-        
-    #ramp = np.interp(data,wiener,r);
-    deconv = np.real(scipy.fft.ifftn(scipy.fft.fftn(vol, overwrite_x=True, workers=ncpu) * ramp, overwrite_x=True, workers=ncpu))
-    deconv = deconv.astype(np.float32)
+    # squared frequency along each axis in fft order (ifftshift of -floor(n/2) ... n-1-floor(n/2)),
+    # normalized to 1 at floor(n/2)
+    freq2 = []
+    for n in shape:
+        half = int(n / 2)
+        m = np.fft.ifftshift(np.arange(-half, n-half)).astype(np.float32) / max(1, half)
+        freq2.append(m**2)
+    freq2[2] = freq2[2][:shape[2]//2+1]
+
+    ramp = np.empty((shape[0], shape[1], shape[2]//2+1), dtype=np.float32)
+    for i in range(shape[0]):
+        r = np.sqrt(freq2[1][:, np.newaxis] + freq2[0][i] + freq2[2][np.newaxis, :])
+        ramp[i] = np.interp(np.minimum(1, r), data, wiener)
+    ramp.setflags(write=False)
+    return ramp
+
+# wiener_ramp cached per shape and CTF parameters, so the chunks of one shape deconvolved by a process share it.
+# whole tomograms use wiener_ramp, their filter is freed after the deconvolution
+cached_wiener_ramp = functools.lru_cache(maxsize=4)(wiener_ramp)
+
+def wiener_deconv(vol, ramp, ncpu=8):
+    # real(ifftn(fftn(vol) * ramp)) through rfftn/irfftn, the ramp being point symmetric (float32)
+    f_vol = scipy.fft.rfftn(vol, workers=ncpu)
+    f_vol *= ramp
+    return scipy.fft.irfftn(f_vol, s=vol.shape, overwrite_x=True, workers=ncpu).astype(np.float32, copy=False)
+
+def tom_deconv_tomo(vol_file, out_file,angpix, voltage, cs, defocus, snrfalloff, deconvstrength, highpassnyquist, phaseflipped, phaseshift, ncpu=8, cache_ramp=False):
+    with mrcfile.open(vol_file, permissive=True) as f:
+        header_in = f.header
+        vol = f.data
+        voxelsize = f.voxel_size
+    ramp_fn = cached_wiener_ramp if cache_ramp else wiener_ramp
+    deconv = wiener_deconv(vol, ramp_fn(tuple(vol.shape), angpix, voltage, cs, defocus, snrfalloff, deconvstrength, highpassnyquist, phaseflipped, phaseshift), ncpu)
     std_deconv = np.std(deconv)
     std_vol = np.std(vol)
     ave_vol = np.average(vol)
-    del vol,ramp
+    del vol
     gc.collect()
     # deconv = deconv/std_deconv* std_vol + ave_vol
     deconv /= std_deconv
@@ -199,7 +192,7 @@ def deconv_one(tomo, out_tomo, isonet_folder="IsoNet", voltage=300.0, cs=2.7, de
         chunks_deconv_list = []
         with Pool(ncpu) as p:
             partial_func = partial(tom_deconv_tomo,out_file=None,angpix=pixel_size,voltage=voltage, cs=cs, defocus=defocus, snrfalloff=snrfalloff,
-                    deconvstrength=deconvstrength, highpassnyquist=highpassnyquist, phaseflipped=False, phaseshift=0,ncpu=1) 
+                    deconvstrength=deconvstrength, highpassnyquist=highpassnyquist, phaseflipped=False, phaseshift=0,ncpu=1,cache_ramp=True) 
             chunks_deconv_list = list(p.map(partial_func,chunks_list))
         vol_restored = c.restore(chunks_deconv_list)
         
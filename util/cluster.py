@@ -0,0 +1,140 @@
+import numpy as np
+from scipy import ndimage
+
+def find_blocks(seg_map, threshold=0.1, min_voxels=0, method="label"):
+    '''
+    group the activated voxels (> threshold) of a seg map into blocks, one block per particle
+    returns the block centers (z, y, x) and voxel numbers of blocks having at least min_voxels voxels
+
+    method "label": connected component labeling, voxels sharing a face or an edge belong to the same block.
+                    runs in linear time of the map size
+    method "hcluster": hierarchy clustering of the activated voxels with distance 1.5, gives the same blocks.
+                    it builds a pairwise distance matrix (O(n^2) memory), only use it to check results on small maps
+    '''
+    activated = seg_map > threshold
+
+    if method == "label":
+        labels, num_blocks = ndimage.label(activated, structure=ndimage.generate_binary_structure(3, 2))
+        if num_blocks == 0:
+            return np.zeros((0, 3)), np.zeros(0, dtype=int)
+        counts = np.bincount(labels.ravel(), minlength=num_blocks+1)[1:]
+        valid = np.nonzero(counts >= min_voxels)[0]
+        if len(valid) == 0:
+            return np.zeros((0, 3)), np.zeros(0, dtype=int)
+        centers = np.array(ndimage.center_of_mass(activated, labels, valid+1))
+        return centers, counts[valid]
+
+    elif method == "hcluster":
+        import scipy.cluster.hierarchy as hcluster
+        points = np.argwhere(activated)
+        if points.shape[0] == 0:
+            return np.zeros((0, 3)), np.zeros(0, dtype=int)
+        if points.shape[0] == 1:
+            clusters = np.ones(1, dtype=int)
+        else:
+            clusters = hcluster.fclusterdata(points, 1.5, criterion="distance")
+        # sort once so that each cluster is a contiguous run, instead of scanning all points for every cluster
+        order = np.argsort(clusters, kind="stable")
+        counts = np.bincount(clusters)[1:]
+        sums = np.add.reduceat(points[order].astype(np.float64), np.concatenate(([0], np.cumsum(counts)[:-1])), axis=0)
+        valid = np.nonzero(counts >= min_voxels)[0]
+        return sums[valid]/counts[valid, np.newaxis], counts[valid]
+
+    else:
+        raise ValueError("block finding method should be 'label' or 'hcluster', got {}".format(method))
+
+def radius_clusters(points, radius):
+    '''
+    single linkage grouping: points closer than radius (directly or through a chain of neighbors) share the same cluster
+    same clusters as hcluster.fclusterdata(points, radius, criterion="distance"), but built from a cKDTree radius graph,
+    so memory scales with the number of neighbor pairs instead of n^2
+    returns cluster labels 0..k-1
+    '''
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    points = np.asarray(points, dtype=np.float64)
+    n = points.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    pairs = cKDTree(points).query_pairs(radius, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:,0], pairs[:,1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+def cluster_members(labels, min_size=1):
+    '''
+    indices of the members of each cluster (ordered by cluster label), clusters smaller than min_size are dropped
+    '''
+    labels = np.asarray(labels)
+    if labels.shape[0] == 0:
+        return []
+    order = np.argsort(labels, kind="stable")
+    counts = np.bincount(labels)
+    members = np.split(order, np.cumsum(counts)[:-1])
+    return [m for m in members if len(m) >= min_size]
+
+def remove_duplicates(points, radius, scores=None):
+    '''
+    keep one particle for each group of particles within radius (single linkage):
+    the one with the highest score (e.g. CCC) wins, the first one is kept on ties or if no score is given
+    returns the indices of the kept particles, ordered by cluster
+    '''
+    labels = radius_clusters(points, radius)
+    n = labels.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    scores = np.zeros(n) if scores is None else np.asarray(scores, dtype=np.float64)
+    order = np.lexsort((np.arange(n), -scores, labels))
+    sorted_labels = labels[order]
+    first = np.concatenate(([True], sorted_labels[1:] != sorted_labels[:-1]))
+    return order[first]
+
+def filter_patches(points, radius, min_patch_size):
+    '''
+    group particles into patches (lattices) with single linkage of distance radius, and drop patches with less than min_patch_size particles
+    returns the number of detected patches and the indices of particles in each kept patch
+    '''
+    labels = radius_clusters(points, radius)
+    num_patches = labels.max()+1 if labels.shape[0] > 0 else 0
+    return num_patches, cluster_members(labels, min_size=min_patch_size)
+
+def maxclust_clusters(points, n_clusters):
+    '''
+    split particles into at most n_clusters single linkage clusters, same as hcluster.fclusterdata(points, n_clusters, criterion="maxclust")
+    the exact minimum spanning tree is grown point by point (Prim) with O(n) memory instead of the O(n^2) distance matrix,
+    then cut at the lowest distance leaving at most n_clusters clusters
+    returns cluster labels 0..k-1
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    points = np.asarray(points, dtype=np.float64)
+    n = points.shape[0]
+    if n <= n_clusters:
+        return np.arange(n)
+
+    # distance of each point to the tree and its closest tree point
+    dist = np.full(n, np.inf)
+    parent = np.zeros(n, dtype=int)
+    in_tree = np.zeros(n, dtype=bool)
+    rows, cols, weights = np.zeros(n-1, dtype=int), np.zeros(n-1, dtype=int), np.zeros(n-1)
+    current = 0
+    for i in range(n-1):
+        in_tree[current] = True
+        d = np.sqrt(np.sum((points - points[current])**2, axis=1))
+        closer = d < dist
+        dist[closer] = d[closer]
+        parent[closer] = current
+        dist[in_tree] = np.inf
+        current = int(np.argmin(dist))
+        rows[i], cols[i], weights[i] = parent[current], current, dist[current]
+
+    # like fcluster, all edges up to the threshold distance are kept, tied edges are never split
+    keep = np.ones(n-1, dtype=bool)
+    if n_clusters > 1:
+        threshold = np.sort(weights)[n-1-n_clusters]
+        keep = weights <= threshold
+    pruned = coo_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=(n, n))
+    return connected_components(pruned, directed=False)[1]
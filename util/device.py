@@ -0,0 +1,187 @@
+import contextlib, queue, threading
+import torch
+
+from TomoNet.util.io import log
+from TomoNet.util.parallel import free_memory
+
+def get_device(gpuID=None, ncpus=None, logger=None):
+    '''
+    select the device used for inference: visible CUDA GPU(s) first, then Apple MPS, otherwise CPU.
+    gpuID "cpu" (or "None") forces CPU. On CPU, ncpus sets the number of torch threads.
+    '''
+    force_cpu = str(gpuID).strip().lower() in ["cpu", "none", "-1"]
+    if not force_cpu and torch.cuda.is_available() and torch.cuda.device_count() > 0:
+        device = torch.device("cuda")
+        for i in range(torch.cuda.device_count()):
+            log(logger, "Run inference on GPU {}: {}".format(i, torch.cuda.get_device_properties(i).name))
+    elif not force_cpu and hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        device = torch.device("mps")
+        log(logger, "Run inference on Apple MPS")
+    else:
+        device = torch.device("cpu")
+        if ncpus is not None and int(ncpus) > 0:
+            torch.set_num_threads(int(ncpus))
+        log(logger, "Run inference on CPU with {} threads".format(torch.get_num_threads()))
+    return device
+
+def device_count(device):
+    # number of devices a batch is split over, all visible GPUs for "cuda" but only one for "cuda:i"
+    if device.type == "cuda" and device.index is None:
+        return max(torch.cuda.device_count(), 1)
+    return 1
+
+def device_list(device):
+    # devices work can be scheduled on independently: each visible GPU for "cuda", otherwise device itself
+    if device.type == "cuda" and device.index is None:
+        return [torch.device("cuda", i) for i in range(max(torch.cuda.device_count(), 1))]
+    return [device]
+
+def inference_model(model, device, channels_last=False):
+    '''
+    move the model to device (wrapped with DataParallel if device is "cuda" and several GPUs are visible) and set it to eval mode
+    '''
+    model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
+    if device_count(device) > 1:
+        model = torch.nn.DataParallel(model)
+    model.eval()
+    return model
+
+def to_device(x, device, channels_last=False):
+    x = torch.as_tensor(x).to(device, non_blocking=True)
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last_3d)
+    return x
+
+def inference_context(device, bf16=False):
+    '''
+    torch.inference_mode, plus bfloat16 autocast if asked for (CPU or GPU supporting it)
+    '''
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if bf16:
+        stack.enter_context(torch.autocast(device_type=device.type, dtype=torch.bfloat16))
+    return stack
+
+class SegmentationHead(torch.nn.Module):
+    '''
+    sigmoid (and binarization with threshold, if given) as part of the forward pass, so it runs on the device(s) with the network.
+    binarized maps are returned as uint8 to cut the device to host copy
+    '''
+    def __init__(self, model, threshold=None):
+        super(SegmentationHead, self).__init__()
+        self.model = model
+        self.threshold = threshold
+
+    def forward(self, x):
+        prob = torch.sigmoid(self.model(x).float())
+        if self.threshold is None:
+            return prob
+        return (prob >= self.threshold).to(torch.uint8)
+
+def available_memory(device):
+    # free memory (bytes) of the device, the smallest one if several GPUs are used
+    if device.type == "cuda" and device.index is not None:
+        return torch.cuda.mem_get_info(device.index)[0]
+    if device.type == "cuda":
+        return min([torch.cuda.mem_get_info(i)[0] for i in range(torch.cuda.device_count())])
+    if device.type == "mps" and hasattr(torch.mps, "recommended_max_memory"):
+        return torch.mps.recommended_max_memory() - torch.mps.current_allocated_memory()
+    return free_memory()
+
+def sample_memory(model, sample_shape, device, bf16=False, channels_last=False):
+    '''
+    memory (bytes) used by the forward pass of one sample: the peak allocation on CUDA,
+    otherwise the sum of all layer outputs, which is an upper bound
+    '''
+    model = model.module if isinstance(model, torch.nn.DataParallel) else model
+    x = to_device(torch.zeros((1,) + tuple(sample_shape), dtype=torch.float32), device, channels_last)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        with inference_context(device, bf16):
+            model(x)
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - before
+
+    total = [x.numel() * x.element_size()]
+    def count_output(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            total[0] += output.numel() * output.element_size()
+    hooks = [m.register_forward_hook(count_output) for m in model.modules() if len(list(m.children())) == 0]
+    try:
+        with inference_context(device, bf16):
+            model(x)
+    finally:
+        for h in hooks:
+            h.remove()
+    return total[0]
+
+def auto_batch_size(model, sample_shape, device, bf16=False, channels_last=False, memory_fraction=0.5, max_batch_size=64):
+    '''
+    largest batch size whose forward pass fits into memory_fraction of the free memory of each device,
+    capped at max_batch_size per device
+    '''
+    per_sample = max(sample_memory(model, sample_shape, device, bf16, channels_last), 1)
+    per_device = int(available_memory(device) * memory_fraction // per_sample)
+    return max(1, min(per_device, max_batch_size)) * device_count(device)
+
+def prefetch(iterable, depth=2, discard=None):
+    '''
+    run iterable in a background thread, keeping up to depth items ready;
+    exceptions raised while producing items are re-raised in the consumer.
+    when the consumer stops early (error, break, close), the producer stops too and the items produced
+    but never consumed are passed to discard (e.g. to close open files)
+    '''
+    items = queue.Queue(maxsize=max(depth, 1))
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        # False if the consumer stopped before the item could be queued
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def drain():
+        while True:
+            try:
+                item, error = items.get_nowait()
+            except queue.Empty:
+                return
+            if error is None and item is not done and discard is not None:
+                discard(item)
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    if discard is not None:
+                        discard(item)
+                    break
+            else:
+                put((done, None))
+        except Exception as e:
+            put((None, e))
+        if stop.is_set():
+            drain()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        drain()
@@ -0,0 +1,81 @@
+import os, queue, threading
+import mrcfile
+
+def free_memory():
+    # available physical memory (bytes), 4 GB if it cannot be read on this platform
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3
+
+def peak_memory():
+    # peak resident memory (bytes) of this process so far, 0 if it cannot be read on this platform
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, ValueError, OSError, AttributeError):
+        return 0
+
+def tomogram_bytes(path, itemsize=4):
+    # size of the tomogram in memory as float32, read from the mrc header only
+    with mrcfile.open(path, header_only=True, permissive=True) as mrc:
+        return int(mrc.header.nx) * int(mrc.header.ny) * int(mrc.header.nz) * itemsize
+
+def bounded_workers(task_bytes, ncpus=None, num_tasks=None, memory_fraction=0.7):
+    '''
+    number of worker processes: at most ncpus (all cores if None) and num_tasks,
+    and no more than the tasks of task_bytes peak memory fitting into memory_fraction of the free memory
+    '''
+    workers = ncpus if ncpus is not None and ncpus > 0 else (os.cpu_count() or 1)
+    if num_tasks is not None:
+        workers = min(workers, num_tasks)
+    if task_bytes > 0:
+        workers = min(workers, int(free_memory() * memory_fraction // task_bytes))
+    return max(workers, 1)
+
+class WriterPool:
+    '''
+    run writes in background threads while the caller keeps computing. submit(fn, *args) queues one write and blocks
+    while max_pending writes are waiting, so the data held by the queue stays bounded whatever the number of writes.
+    the first error raised by a write is re-raised by the next submit or by close
+    '''
+    def __init__(self, workers=2, max_pending=8):
+        self.tasks = queue.Queue(maxsize=max(max_pending, 1))
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(workers, 1))]
+        for t in self.threads:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                self.errors.append(e)
+
+    def _raise(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def submit(self, fn, *args):
+        self._raise()
+        self.tasks.put((fn, args))
+
+    def close(self):
+        # wait for the queued writes to finish
+        for _ in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self._raise()
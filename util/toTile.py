@@ -1,3 +1,4 @@
+import math
 import numpy as np
 
 class reform3D:
@@ -81,5 +82,142 @@ class reform3D:
         print ('orig_sp',orig_sp)
         return padded[:orig_sp[0][0]][:orig_sp[0][1]][:orig_sp[0][2]]
 
+def mask_occupancy(mask, block_size):
+    #block-reduced mask: True for each block_size^3 block holding any positive mask voxel
+    #the mask is read block_size slices at a time, so a memory-mapped mask is never loaded as a whole
+    sp = np.array(mask.shape)
+    grid = -(-sp//block_size)
+    occupancy = np.zeros(grid, dtype=bool)
+    for i in range(grid[0]):
+        slab = np.asarray(mask[i*block_size:(i+1)*block_size]) > 0
+        slab = np.pad(slab, [(0, block_size-slab.shape[0]), (0, grid[1]*block_size-sp[1]), (0, grid[2]*block_size-sp[2])])
+        occupancy[i] = slab.reshape(block_size, grid[1], block_size, grid[2], block_size).any(axis=(0, 2, 4))
+    return occupancy
+
+def tile_origins(shape, crop_size, cube_size, mask=None, block_size=None):
+    #origins (z, y, x) of crop_size tiles stepping by cube_size, tiles running over the volume edge are moved back inside it
+    #tiles without any mask coverage are dropped when a mask is given: the mask is reduced once to an occupancy grid
+    #(blocks of block_size, gcd of crop_size and cube_size by default) and a summed-area table of it answers each tile in O(1).
+    #only tiles not aligned with the grid (moved back at the volume edge) and touching occupied blocks are checked on the mask itself
+    sp = np.array(shape)
+    sidelen = (sp//cube_size) + 1
+    starts = [np.array(sorted(set([min(i*cube_size, s-crop_size) for i in range(n-1)] + [s-crop_size]))) for s, n in zip(sp, sidelen)]
+
+    if mask is None:
+        keep = np.ones([len(st) for st in starts], dtype=bool)
+    else:
+        block_size = block_size if block_size is not None else math.gcd(crop_size, cube_size)
+        occupancy = mask_occupancy(mask, block_size)
+        sat = np.zeros(np.array(occupancy.shape)+1, dtype=np.int64)
+        sat[1:,1:,1:] = occupancy.cumsum(0).cumsum(1).cumsum(2)
+
+        lo = [st//block_size for st in starts]
+        hi = [-(-(st+crop_size)//block_size) for st in starts]
+        z0, y0, x0 = np.ix_(*lo)
+        z1, y1, x1 = np.ix_(*hi)
+        occupied = sat[z1,y1,x1] - sat[z0,y1,x1] - sat[z1,y0,x1] - sat[z1,y1,x0] \
+                    + sat[z0,y0,x1] + sat[z0,y1,x0] + sat[z1,y0,x0] - sat[z0,y0,x0]
+        keep = occupied > 0
+
+        # the occupancy of tiles covering partial blocks is an upper bound, check those on the mask
+        aligned = [(st%block_size == 0) & (((st+crop_size)%block_size == 0) | (st+crop_size == s)) for st, s in zip(starts, sp)]
+        inexact = keep & ~(aligned[0][:,None,None] & aligned[1][None,:,None] & aligned[2][None,None,:])
+        for i, j, k in np.argwhere(inexact):
+            z, y, x = starts[0][i], starts[1][j], starts[2][k]
+            keep[i,j,k] = np.any(np.asarray(mask[z:z+crop_size, y:y+crop_size, x:x+crop_size]) > 0)
+
+    return [(int(starts[0][i]), int(starts[1][j]), int(starts[2][k])) for i, j, k in np.argwhere(keep)]
+
+def iter_tiles(data, origins, crop_size):
+    #yield (view, origin) for each tile origin, no copy of the input volume is made
+    for origin in origins:
+        z1, y1, x1 = origin
+        yield data[z1:z1+crop_size, y1:y1+crop_size, x1:x1+crop_size], origin
+
+class Stitcher:
+    """Blend overlapping tiles into one preallocated float32 volume.
+
+    mode 'max' keeps the highest value seen for each voxel, 'mean' averages all the tiles
+    covering a voxel and 'cosine' averages them with a separable cosine (hann) window,
+    so that voxels near the tile borders, where the network is less reliable, weigh less.
+    """
+    def __init__(self, shape, crop_size, mode='max'):
+        if mode not in ['max', 'mean', 'cosine']:
+            raise ValueError("stitching mode should be one of 'max', 'mean' or 'cosine', got {}".format(mode))
+        self.mode = mode
+        self._map = np.zeros(shape, dtype=np.float32)
+        self._weight = None
+        self._window = None
+        if mode != 'max':
+            self._weight = np.zeros(shape, dtype=np.float32)
+        if mode == 'cosine':
+            # offset by half a voxel so that the border voxels still get a (small) positive weight
+            w = (np.sin(np.pi*(np.arange(crop_size)+0.5)/crop_size)**2).astype(np.float32)
+            self._window = w[:,np.newaxis,np.newaxis]*w[np.newaxis,:,np.newaxis]*w[np.newaxis,np.newaxis,:]
+
+    def add(self, tile, origin):
+        region = tuple(slice(o, o+s) for o, s in zip(origin, tile.shape))
+        if self.mode == 'max':
+            np.maximum(self._map[region], tile, out=self._map[region])
+        elif self.mode == 'mean':
+            self._map[region] += tile
+            self._weight[region] += 1
+        else:
+            self._map[region] += tile*self._window
+            self._weight[region] += self._window
+
+    def result(self):
+        if self._weight is not None:
+            np.divide(self._map, self._weight, out=self._map, where=self._weight > 0)
+            self._weight = None
+        return self._map
+
+def symmetric_crop(data, origin, size):
+    #float32 copy of the size^3 region of data at origin (z, y, x), which may run over the volume borders:
+    #outside voxels are mirrored as np.pad(data, ..., 'symmetric') would, but only the region itself is read
+    index = []
+    for o, n in zip(origin, data.shape):
+        i = np.arange(o, o+size) % (2*n)
+        index.append(np.where(i < n, i, 2*n-1-i))
+    if all([o >= 0 and o+size <= n for o, n in zip(origin, data.shape)]):
+        return np.array(data[origin[0]:origin[0]+size, origin[1]:origin[1]+size, origin[2]:origin[2]+size], dtype=np.float32)
+    # read the bounding box of the mirrored indices, then pick from it
+    lo = [int(i.min()) for i in index]
+    box = np.asarray(data[lo[0]:index[0].max()+1, lo[1]:index[1].max()+1, lo[2]:index[2].max()+1], dtype=np.float32)
+    return box[np.ix_(*[i-l for i, l in zip(index, lo)])]
+
+def block_origins(shape, cube_size):
+    #origins (z, y, x) of the cube_size blocks covering the volume, in the order of reform3D.pad_and_crop_new
+    #(the blocks lying fully beyond the volume, which pad_and_crop_new adds when a side is a multiple of cube_size, are left out)
+    grid = [-(-s//cube_size) for s in shape]
+    return [(i*cube_size, j*cube_size, k*cube_size) for i, j, k in np.ndindex(*grid)]
+
+def iter_block_tiles(data, cube_size, crop_size, origins=None):
+    #yield (block origin, tile) for each cube_size block (all of block_origins if origins is None): the float32 crop_size tile
+    #centered on the block, cut from data (e.g. memory-mapped) on the fly with symmetric padding at the borders.
+    #the same tiles as reform3D.pad_and_crop_new, without building the padded volume or the stack of all tiles
+    pad = (crop_size - cube_size)//2
+    for origin in (origins if origins is not None else block_origins(data.shape, cube_size)):
+        yield origin, symmetric_crop(data, [o-pad for o in origin], crop_size)
+
+def block_weight(occupancy, origin, cube_size, shape):
+    #weight (float32) of the network output in the cube_size block at origin, clipped to the volume shape:
+    #1 in occupied blocks (see mask_occupancy), decreasing linearly to 0 over one block from the occupied blocks around it.
+    #only occupied blocks and their neighbors (scipy.ndimage.binary_dilation with a 3x3x3 structure) have weights > 0
+    index = [o//cube_size for o in origin]
+    positions = [np.arange(o, min(o+cube_size, s)) + 0.5 for o, s in zip(origin, shape)]
+    if occupancy[tuple(index)]:
+        return np.ones([len(p) for p in positions], dtype=np.float32)
+    weight = np.zeros([len(p) for p in positions], dtype=np.float32)
+    for shift in np.ndindex(3, 3, 3):
+        neighbor = [i+d-1 for i, d in zip(index, shift)]
+        if min(neighbor) < 0 or any([n >= g for n, g in zip(neighbor, occupancy.shape)]) or not occupancy[tuple(neighbor)]:
+            continue
+        # chebyshev distance of the voxels to the occupied neighbor block
+        dist = [np.maximum(np.maximum(n*cube_size - p, p - (n+1)*cube_size), 0) for n, p in zip(neighbor, positions)]
+        dist = np.maximum(np.maximum(dist[0][:,None,None], dist[1][None,:,None]), dist[2][None,None,:])
+        np.maximum(weight, 1 - dist/cube_size, out=weight)
+    return weight
+
 if __name__ == '__main__':
     pass